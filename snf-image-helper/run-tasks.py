@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Run the configuration tasks of the helper VM
+
+This program runs the executable files of a directory, like run-parts does,
+but independent tasks run at the same time. A task does not start before all
+the tasks with a smaller numeric prefix have finished. The tasks that share the
+same prefix run in parallel, unless their task_init_as line declares otherwise
+with the following arguments:
+
+    after=<Task>[,<Task>...]      do not start before these tasks finish
+    conflicts=<Task>[,<Task>...]  do not run at the same time as these tasks
+
+where <Task> is the name of a task without its numeric prefix. The output of
+each task is prefixed with its name. After a task fails, no other task is
+started and the program exits with the exit code of the failed task once the
+running ones have finished.
+"""
+
+import sys
+import os
+import re
+import signal
+import threading
+import subprocess
+from optparse import OptionParser
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+# The file names that run-parts accepts by default
+VALID_NAME = re.compile(r'^[a-zA-Z0-9_-]+$')
+TASK_NAME = re.compile(r'^(\d*)(.*)$')
+DECLARATION = re.compile(r'^\s*task_init_as\s+(.*)$')
+
+
+def parse_arguments(input_args):
+    usage = "Usage: %prog [options] <tasks_dir>"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=0,
+                      metavar="JOBS",
+                      help="run at most JOBS tasks at the same time. "
+                      "0 means no limit [default: %default]")
+
+    (options, args) = parser.parse_args(input_args)
+
+    if len(args) != 1:
+        parser.error("Wrong number of arguments")
+
+    if options.jobs < 0:
+        parser.error("The number of jobs cannot be negative")
+
+    options.tasks_dir = args[0]
+
+    return options
+
+
+class Task(object):
+    """A configuration task found in the tasks directory"""
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.priority, self.name = TASK_NAME.match(self.filename).groups()
+        self.after = set()
+        self.conflicts = set()
+        self.process = None
+        self.output = None
+
+        with open(path) as f:
+            for line in f:
+                match = DECLARATION.match(line)
+                if match is None:
+                    continue
+                declaration = match.group(1)
+                # The declaration may span multiple lines
+                while declaration.rstrip().endswith('\\'):
+                    declaration = declaration.rstrip()[:-1] + " " + next(f, '')
+                for arg in declaration.split():
+                    key, _, value = arg.partition('=')
+                    if key == 'after':
+                        self.after.update(value.split(','))
+                    elif key == 'conflicts':
+                        self.conflicts.update(value.split(','))
+                break
+
+    def start(self, lock):
+        sys.stderr.write("%s: executing %s\n" % (PROGNAME, self.path))
+        sys.stderr.flush()
+        self.process = subprocess.Popen(
+            [self.path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            close_fds=True, preexec_fn=lambda: signal.signal(signal.SIGPIPE,
+                                                             signal.SIG_DFL))
+        self.output = threading.Thread(target=self.copy_output, args=(lock,))
+        self.output.start()
+
+    def copy_output(self, lock):
+        for line in iter(self.process.stdout.readline, ''):
+            with lock:
+                sys.stdout.write("%s: %s" % (self.filename, line))
+                if not line.endswith('\n'):
+                    sys.stdout.write('\n')
+                sys.stdout.flush()
+        self.process.stdout.close()
+
+    def finish(self, status):
+        """Waits for the output of a task that has exited and returns its exit
+        code"""
+        self.output.join()
+        if os.WIFSIGNALED(status):
+            return 128 + os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+
+def find_tasks(tasks_dir):
+    """Returns the tasks of a directory in the order run-parts would run them
+    """
+    tasks = []
+    for filename in sorted(os.listdir(tasks_dir)):
+        path = os.path.join(tasks_dir, filename)
+        if VALID_NAME.match(filename) and os.path.isfile(path) and \
+                os.access(path, os.X_OK):
+            tasks.append(Task(path))
+    return tasks
+
+
+def dependencies(tasks):
+    """Returns the tasks each task has to wait for"""
+    names = dict((t.name, t) for t in tasks)
+    deps = {}
+    for task in tasks:
+        deps[task] = set(t for t in tasks if t.priority < task.priority)
+        # Ignore the tasks that are not installed
+        deps[task].update(names[n] for n in task.after if n in names)
+
+    # Make sure that the tasks will not wait for each other forever
+    finished = set()
+    while len(finished) < len(tasks):
+        ready = [t for t in tasks if t not in finished and
+                 deps[t] <= finished]
+        if not ready:
+            raise ValueError("Circular dependency between tasks: %s" %
+                             " ".join(sorted(t.name for t in tasks
+                                             if t not in finished)))
+        finished.update(ready)
+
+    return deps
+
+
+def conflict(task, other):
+    return task.name in other.conflicts or other.name in task.conflicts
+
+
+def run_tasks(tasks, jobs):
+    """Runs the tasks and returns the exit code of the first one that failed
+    """
+    deps = dependencies(tasks)
+    pending = list(tasks)
+    running = {}
+    finished = set()
+    lock = threading.Lock()
+    ret = 0
+
+    while pending or running:
+        if ret == 0:
+            for task in list(pending):
+                if jobs and len(running) >= jobs:
+                    break
+                if not deps[task] <= finished or \
+                        [t for t in running.values() if conflict(task, t)]:
+                    continue
+                pending.remove(task)
+                task.start(lock)
+                running[task.process.pid] = task
+
+        if not running:
+            break
+
+        pid, status = os.wait()
+        task = running.pop(pid, None)
+        if task is None:
+            continue
+
+        code = task.finish(status)
+        if code != 0:
+            sys.stderr.write("%s: %s exited with return code %d\n" %
+                             (PROGNAME, task.path, code))
+            sys.stderr.flush()
+            if ret == 0:
+                ret = code
+        finished.add(task)
+
+    return ret
+
+
+if __name__ == "__main__":
+    options = parse_arguments(sys.argv[1:])
+
+    try:
+        tasks = find_tasks(options.tasks_dir)
+        ret = run_tasks(tasks, options.jobs)
+    except (OSError, IOError, ValueError) as e:
+        sys.stderr.write("%s: %s\n" % (PROGNAME, e))
+        sys.exit(1)
+
+    sys.exit(ret)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Compare the zero block detection of rbd_import against the set based check it
+used to perform, on synthetic images with a varying fraction of zero blocks.
+The RBD python bindings are not needed to run this.
+"""
+
+import os
+import sys
+import imp
+import time
+import types
+import random
+import optparse
+
+# Zero detection does not talk to the cluster
+for name in ('rados', 'rbd'):
+    sys.modules.setdefault(name, types.ModuleType(name))
+
+rbd_import = imp.load_source(
+    'rbd_import', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'rbd_import'))
+
+
+def old_check(data):
+    """The zero check rbd_import used to perform on each block"""
+    return data[0] == '\0' and len(set(data)) == 1
+
+
+def synthetic_image(blocks, block_size, zero_ratio):
+    """Return a list of blocks, zero_ratio of which are zero-filled"""
+    data = os.urandom(block_size)
+    zero = '\0' * block_size
+    # Non-zero blocks that only differ from zero at their end are the worst
+    # case for both checks
+    tail = '\0' * (block_size - 1) + '\1'
+    return [zero if random.random() < zero_ratio else
+            random.choice((data, tail)) for _ in xrange(blocks)]
+
+
+def bench_old(image, block_size, obj_size):
+    start = time.time()
+    for block in image:
+        old_check(block)
+    return time.time() - start
+
+
+def bench_new(image, block_size, obj_size):
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    zero = memoryview(bytearray(obj_size))
+    start = time.time()
+    for block in image:
+        # rbd_import reads each block into a preallocated buffer
+        buf[:] = block
+        rbd_import.zero_ranges(view, block_size, obj_size, zero)
+    return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-b", "--block-size", type="int", dest="block_size",
+                      default=rbd_import.DEFAULT_BLOCK_SIZE,
+                      help="size of the blocks read from the input")
+    parser.add_option("-o", "--object-size", type="int", dest="obj_size",
+                      default=4 * 1024 * 1024,
+                      help="size of the RBD objects")
+    parser.add_option("-n", "--blocks", type="int", dest="blocks",
+                      default=64, help="number of blocks per image")
+    (options, args) = parser.parse_args()
+
+    size = options.blocks * options.block_size
+    print "%-10s %12s %12s %12s" % ("zeros", "old (MiB/s)", "new (MiB/s)",
+                                    "speedup")
+    for zero_ratio in (0.0, 0.5, 0.9, 1.0):
+        image = synthetic_image(options.blocks, options.block_size,
+                                zero_ratio)
+        old = bench_old(image, options.block_size, options.obj_size)
+        new = bench_new(image, options.block_size, options.obj_size)
+        print "%-10s %12.1f %12.1f %11.1fx" % (
+            "%d%%" % (zero_ratio * 100), size / old / 2 ** 20,
+            size / new / 2 ** 20, old / new)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
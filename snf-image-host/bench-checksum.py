@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Benchmark of the checksum verification of copy-monitor.py.
+
+The utility creates a random image and copies it with copy-monitor.py, the
+way the create script does, first without computing a checksum and then with
+each of the supported algorithms. The image is either streamed through pipes
+or, in file mode, copied by the parallel workers of copy-monitor.py to a
+regular file. It prints the throughput of every run and the overhead of the
+checksum computation.
+
+The checksum is computed by a separate process while the data are copied, so
+it only slows the copy down if the algorithm hashes slower than the data are
+copied. This overlap needs a second CPU. On hosts with more than one CPU, the
+utility fails if the overhead of an algorithm exceeds the given limit. It
+also fails if a computed checksum does not match the one the standalone
+hashing tool reports.
+"""
+
+import sys
+import os
+import time
+import tempfile
+import subprocess
+import optparse
+import multiprocessing
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+ALGORITHMS = ['sha256', 'blake2b', 'xxhash']
+COMMANDS = {'sha256': ['sha256sum'], 'blake2b': ['b2sum'],
+            'xxhash': ['xxhsum', '-H1']}
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-d", "--directory", type="string", dest="directory",
+                      default=os.path.dirname(os.path.abspath(sys.argv[0])),
+                      metavar="DIR",
+                      help="the directory copy-monitor.py is installed in, "
+                      "along with backendapi.py [default: %default]")
+    parser.add_option("-s", "--size", type="int", dest="size", default=1024,
+                      metavar="MB",
+                      help="the size of the image in megabytes [default: "
+                      "%default]")
+    parser.add_option("-r", "--runs", type="int", dest="runs", default=3,
+                      help="the number of runs of each case. The fastest one "
+                      "is reported [default: %default]")
+    parser.add_option("-o", "--output", type="string", dest="output",
+                      default=None, metavar="FILE",
+                      help="copy the image to FILE, e.g. a file on the "
+                      "storage of the instance disks [default: /dev/null, or "
+                      "a temporary file in file mode]")
+    parser.add_option("-f", "--file-mode", action="store_true",
+                      dest="file_mode", default=False,
+                      help="copy the image file with parallel workers, like "
+                      "deployments on local disks do, instead of streaming "
+                      "it")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+                      help="the number of workers of file mode [default: "
+                      "%default]")
+    parser.add_option("-m", "--max-overhead", type="float",
+                      dest="max_overhead", default=5.0, metavar="PERCENT",
+                      help="fail if the overhead of an algorithm exceeds "
+                      "PERCENT on a host with more than one CPU [default: "
+                      "%default]")
+    parser.add_option("-a", "--algorithm", action="append",
+                      dest="algorithms", choices=ALGORITHMS,
+                      metavar="ALGORITHM",
+                      help="benchmark only ALGORITHM. May be given more than "
+                      "once [default: all the algorithms whose tool is "
+                      "installed]")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 0:
+        parser.error('Wrong number of arguments')
+
+    if options.size <= 0:
+        parser.error("Invalid size: `%d'" % options.size)
+
+    if options.runs <= 0:
+        parser.error("Invalid number of runs: `%d'" % options.runs)
+
+    if options.jobs <= 0:
+        parser.error("Invalid number of jobs: `%d'" % options.jobs)
+
+    if options.file_mode and options.output is not None and \
+            not os.path.isfile(options.output):
+        parser.error("File mode requires a regular output file")
+
+    return options
+
+
+def have_command(command):
+    """Check if a command is found in the PATH"""
+    return any(os.access(os.path.join(path, command), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+
+def create_image(path, size):
+    """Create an image of random data with the given size in megabytes"""
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for _ in range(size):
+            f.write(block)
+
+
+def expected_digest(algorithm, image):
+    """Return the checksum the standalone hashing tool computes"""
+    with open(image, 'rb') as f:
+        output = subprocess.check_output(COMMANDS[algorithm], stdin=f)
+    return output.split()[0]
+
+
+def copy(monitor, image, size, algorithm, digest_file, output, jobs=None):
+    """Copy the image with copy-monitor.py and return the elapsed time. If
+    jobs is given, the image file is copied in file mode."""
+    cmd = "%s -o 3 -t %d -b $(cat /proc/sys/fs/pipe-max-size)" % \
+        (monitor, size)
+    if algorithm is not None:
+        cmd += " --checksum %s %s" % (algorithm, digest_file)
+    if jobs is not None:
+        cmd += " -j %d %s 3>/dev/null 1<> %s" % (jobs, image, output)
+    else:
+        cmd = "cat %s | %s 3>/dev/null | cat > %s" % (image, cmd, output)
+
+    start = time.time()
+    subprocess.check_call(['bash', '-o', 'pipefail', '-c', cmd])
+    return time.time() - start
+
+
+def main():
+    options = parse_options(sys.argv[1:])
+
+    monitor = os.path.join(options.directory, 'copy-monitor.py')
+    if not os.access(monitor, os.X_OK):
+        sys.stderr.write("%s: `%s' is not executable\n" % (PROGNAME, monitor))
+        return 1
+
+    algorithms = options.algorithms
+    if algorithms is None:
+        algorithms = [a for a in ALGORITHMS if have_command(COMMANDS[a][0])]
+
+    cpus = multiprocessing.cpu_count()
+    tmpdir = tempfile.mkdtemp()
+    image = os.path.join(tmpdir, 'image')
+    digest_file = os.path.join(tmpdir, 'digest')
+    output = options.output
+    if output is None:
+        output = os.path.join(tmpdir, 'output') if options.file_mode \
+            else os.devnull
+        open(output, 'a').close()
+    jobs = options.jobs if options.file_mode else None
+    size = options.size * 1024 * 1024
+    failed = False
+    try:
+        create_image(image, options.size)
+
+        print "%-10s %10s %10s" % ("checksum", "MB/s", "overhead")
+        baseline = None
+        for algorithm in [None] + algorithms:
+            elapsed = min(copy(monitor, image, size, algorithm, digest_file,
+                               output, jobs)
+                          for _ in range(options.runs))
+            if baseline is None:
+                baseline = elapsed
+            overhead = (elapsed - baseline) * 100.0 / baseline
+            print "%-10s %10.1f %9.1f%%" % (
+                algorithm or "none", options.size / elapsed, overhead)
+
+            if algorithm is not None and cpus > 1 and \
+                    overhead > options.max_overhead:
+                sys.stderr.write("%s: the overhead of %s exceeds %.1f%%\n" %
+                                 (PROGNAME, algorithm, options.max_overhead))
+                failed = True
+
+            if algorithm is not None:
+                with open(digest_file) as f:
+                    digest = f.read().strip()
+                if digest != expected_digest(algorithm, image):
+                    sys.stderr.write("%s: wrong %s checksum: %s\n" %
+                                     (PROGNAME, algorithm, digest))
+                    failed = True
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write("%s: command failed with exit status %d\n" %
+                         (PROGNAME, e.returncode))
+        failed = True
+    finally:
+        for path in (image, digest_file, os.path.join(tmpdir, 'output')):
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rmdir(tmpdir)
+
+    if cpus == 1:
+        sys.stderr.write("%s: hashing cannot overlap the copy on a single "
+                         "CPU. The overheads were not checked.\n" % PROGNAME)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -25,16 +25,25 @@ notifications.
 
 import os
 import sys
+import stat
+import struct
 import time
 import json
 import signal
 import argparse
 import errno
+import threading
+import Queue
 import ctypes
 import ctypes.util
 import fcntl
+import subprocess
 from functools import partial
 
+import backendapi
+import diskimage
+from backendapi import file_extents
+
 MSG_TYPE = "image-copy-progress"
 
 # From bits/fcntl-linux.h
@@ -46,6 +55,20 @@ SPLICE_F_GIFT = 8
 # From linux/fcntl.h
 F_SETPIPE_SZ = 1031
 
+# From linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+# From linux/fs.h
+FICLONERANGE = 0x4020940d  # _IOW(0x94, 13, struct file_clone_range)
+
+# The programs that compute the checksums of the images
+CHECKSUM_COMMANDS = {
+    'sha256': ['sha256sum'],
+    'blake2b': ['b2sum'],
+    'xxhash': ['xxhsum', '-H1'],
+}
+
 
 def make_splice():
     '''Set up a splice(2) wrapper'''
@@ -90,10 +113,89 @@ def make_splice():
     return splice
 
 
-# Build and export wrapper
+def make_libc_call(names, argtypes, restype):
+    '''Set up a wrapper for a libc system call wrapper
+
+    The first of `names` found in libc is used. This allows preferring the LFS
+    versions of the calls, that support 64 bit offsets on 32 bit systems. If
+    none of the names is found, None is returned.
+
+    If the call fails (i.e. returns -1), an `IOError` is raised with the
+    appropriate `errno`. As with `splice`, `EINTR` results in the call to be
+    retried.
+    '''
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    for name in names:
+        c_call = getattr(libc, name, None)
+        if c_call is not None:
+            break
+    else:
+        return None
+    del libc
+
+    c_call.argtypes = argtypes
+    c_call.restype = restype
+
+    def call(*args):
+        '''Wrapper for the libc call'''
+        while True:
+            res = c_call(*args)
+
+            if res == -1:
+                errno_ = ctypes.get_errno()
+
+                # Try again on EINTR
+                if errno_ == errno.EINTR:
+                    continue
+
+                raise IOError(errno_, os.strerror(errno_))
+
+            return res
+
+    call.__name__ = names[-1]
+    return call
+
+
+# Build and export wrappers
 splice = make_splice()  # pylint: disable=invalid-name
 del make_splice
 
+# pylint: disable=invalid-name
+fallocate = make_libc_call(
+    ['fallocate64', 'fallocate'],
+    [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong],
+    ctypes.c_int)
+pread = make_libc_call(
+    ['pread64', 'pread'],
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong],
+    ctypes.c_ssize_t)
+pwrite = make_libc_call(
+    ['pwrite64', 'pwrite'],
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong],
+    ctypes.c_ssize_t)
+tee = make_libc_call(
+    ['tee'], [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint],
+    ctypes.c_ssize_t)
+# This is only available in glibc >= 2.27
+copy_file_range = make_libc_call(
+    ['copy_file_range'],
+    [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+     ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+     ctypes.c_size_t, ctypes.c_uint],
+    ctypes.c_ssize_t)
+# pylint: enable=invalid-name
+
+# copy_file_range(2) errors denoting that the call cannot be used for the
+# given pair of file descriptors
+CFR_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.EBADF)
+
+# FICLONERANGE errors denoting that the files cannot share extents (e.g. they
+# are on different file systems or the file system does not support reflinks)
+CLONE_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                     errno.ENOTTY, errno.EBADF)
+
 
 class Progress(object):
     """Computes the progress made"""
@@ -102,12 +204,16 @@ class Progress(object):
         self.interval = interval
         self.position = start
         self.msg = {"type": MSG_TYPE, "total": total}
+        self.lock = threading.Lock()
         signal.signal(signal.SIGALRM, partial(self.send_progress, self))
+        # Restart system calls interrupted by the alarm
+        signal.siginterrupt(signal.SIGALRM, False)
         signal.alarm(self.interval)
 
     def update(self, val):
         """Update the current progress"""
-        self.position += val
+        with self.lock:
+            self.position += val
 
     def send_progress(self, *_):
         """Send progress to file descriptor"""
@@ -120,6 +226,625 @@ class Progress(object):
         signal.alarm(self.interval)
 
 
+class Checksum(object):
+    """Computes the checksum of the image in a separate process, so that it
+    is hashed in parallel with the copy.
+
+    The data are passed to the process through a pipe, in order, as they are
+    copied. Data that are spliced are duplicated into the pipe with tee(2), so
+    they never reach user space. The rest are written to the pipe. The first
+    `skip' bytes of the data are not part of the image.
+    """
+    def __init__(self, algorithm, skip=0, pipe_size=None):
+        self.fd = None
+        self.skip = skip
+        self.zero = ''
+        try:
+            rfd, self.fd = os.pipe()
+            if pipe_size is not None:
+                fcntl.fcntl(self.fd, F_SETPIPE_SZ, pipe_size)
+            self.process = subprocess.Popen(
+                CHECKSUM_COMMANDS[algorithm], stdin=rfd,
+                stdout=subprocess.PIPE, close_fds=True)
+            os.close(rfd)
+        except OSError as e:
+            raise OSError(e.errno, "Unable to run `%s': %s" %
+                          (CHECKSUM_COMMANDS[algorithm][0], e.strerror))
+
+    def feed(self, data):
+        """Pass a data block (a string or a buffer) to the process"""
+        if self.fd is None:
+            return
+        if self.skip > 0:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = buffer(data, skipped)
+        write_all(self.fd, data)
+
+    def feed_zeros(self, length):
+        """Pass a run of zeros to the process"""
+        if self.fd is None:
+            return
+        while length > 0:
+            if not self.zero:
+                self.zero = '\0' * 65536
+            chunk = min(length, len(self.zero))
+            self.feed(self.zero[:chunk])
+            length -= chunk
+
+    def tee(self, infd, length):
+        """Duplicate up to length bytes of the data waiting in the pipe infd
+        into the process. Returns the number of bytes that should be spliced
+        out of infd before calling this again, which is 0 at the end of the
+        data."""
+        if self.skip > 0:
+            length = min(self.skip, length)
+            self.skip -= length
+            return length
+        return tee(infd, self.fd, length, 0)
+
+    def digest(self):
+        """Wait for the process to finish and return the checksum"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        output = self.process.stdout.read()
+        if self.process.wait() != 0 or not output.split():
+            raise IOError(errno.EIO, "Computing the checksum failed")
+        return output.split()[0]
+
+
+class SparseWriter(object):
+    """Writes data to a seekable file descriptor, leaving holes where the data
+    are all zeros.
+
+    Zero regions are not written. Instead, the writer seeks over them and
+    punches a hole in the destination, so that the region reads back as zeros
+    even if the destination had data there before. If the destination does not
+    support hole punching, the zeros are written out as usual.
+    """
+    def __init__(self, fd, progress, block_size):
+        self.fd = fd
+        self.progress = progress
+        self.zero = '\0' * block_size
+        self.zero_buf = ctypes.create_string_buffer(block_size)
+        self.offset = os.lseek(fd, 0, os.SEEK_CUR)
+        self.hole_start = self.offset
+        self.punch = True
+
+    def write(self, data):
+        """Write a data block to the destination"""
+        if is_zero(data, self.zero):
+            self.skip(len(data))
+            return
+
+        self._fill_hole()
+        write_all(self.fd, data)
+        self.offset += len(data)
+        self.hole_start = self.offset
+        self.progress.update(len(data))
+
+    def skip(self, length):
+        """Skip over a region of the destination that should contain zeros"""
+        self.offset += length
+        self.progress.update(length)
+
+    def close(self):
+        """Finalize the destination and flush it to the disk"""
+        self._fill_hole()
+        finalize_output(self.fd, self.offset)
+
+    def _fill_hole(self):
+        """Make the pending hole region read back as zeros"""
+        length = self.offset - self.hole_start
+        if length == 0:
+            return
+
+        self.punch = zero_range(self.fd, self.hole_start, length,
+                                self.zero_buf, self.punch)
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        self.hole_start = self.offset
+
+
+class ParallelCopier(object):
+    """Copies seekable inputs to a seekable output using a number of worker
+    threads.
+
+    The inputs are split in ranges and every worker copies one range at a time
+    using copy_file_range(2), or pread(2)/pwrite(2) if the former is not
+    supported. In sparse mode, the data are always read and the zero blocks
+    are turned into holes, like SparseWriter does.
+
+    If a Checksum is given, the data are always read and every block is
+    passed to it once the blocks that precede it on the output have been
+    passed. Workers that get ahead wait for their turn, holding a single
+    block. Inputs that are not copied (e.g. because they were cloned) are
+    read only to be hashed.
+    """
+    def __init__(self, fd, progress, jobs, range_size, block_size, sparse,
+                 checksum=None):
+        self.fd = fd
+        self.progress = progress
+        self.jobs = jobs
+        self.range_size = range_size
+        self.block_size = block_size
+        self.sparse = sparse
+        self.zero = '\0' * block_size
+        self.zero_buf = ctypes.create_string_buffer(block_size)
+        self.punch = True
+        self.cfr = copy_file_range is not None and not sparse and \
+            checksum is None
+        self.checksum = checksum
+        self.hashed = None
+        self.cond = threading.Condition()
+        self.ranges = Queue.Queue()
+        self.error = None
+
+    def add(self, infd, offset, size, copy=True):
+        """Schedule the copy of the first `size' bytes of infd to the output
+        at the given offset. If copy is False, the data are only hashed."""
+        if self.hashed is None:
+            self.hashed = offset
+        if not copy and self.checksum is None:
+            return
+
+        if self.sparse and stat.S_ISREG(os.fstat(infd).st_mode):
+            extents = file_extents(infd)
+        else:
+            extents = [(0, size, True)]
+
+        for start, length, is_data in extents:
+            if not is_data:
+                self.ranges.put((None, start, offset + start, length, copy))
+                continue
+            end = start + length
+            while start < end:
+                length = min(self.range_size, end - start)
+                self.ranges.put((infd, start, offset + start, length, copy))
+                start += length
+
+    def run(self):
+        """Perform the copy"""
+        workers = [threading.Thread(target=self._worker)
+                   for _ in range(self.jobs)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # Joining without a timeout would block the SIGALRM handler that
+        # sends the progress messages.
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.5)
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _worker(self):
+        """Worker thread main loop"""
+        buf = ctypes.create_string_buffer(self.block_size)
+        while self.error is None:
+            try:
+                infd, in_offset, out_offset, length, copy = \
+                    self.ranges.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if infd is None:
+                    if copy:
+                        self._zero(out_offset, length)
+                        self.progress.update(length)
+                    self._hash(out_offset, None, length)
+                else:
+                    self._copy(buf, infd, in_offset, out_offset, length, copy)
+            except Exception:  # pylint: disable=broad-except
+                with self.cond:
+                    if self.error is None:
+                        self.error = sys.exc_info()
+                    self.cond.notify_all()
+
+    def _hash(self, offset, data, length):
+        """Pass the block of the output at the given offset to the Checksum,
+        after the preceding ones. If data is None, the block is all zeros."""
+        if self.checksum is None:
+            return
+        with self.cond:
+            while self.hashed != offset:
+                if self.error is not None:
+                    raise IOError(errno.EIO, "Another worker failed")
+                self.cond.wait(0.5)
+        # Only the worker holding the next block may pass it
+        if data is None:
+            self.checksum.feed_zeros(length)
+        else:
+            self.checksum.feed(data)
+        with self.cond:
+            self.hashed += length
+            self.cond.notify_all()
+
+    def _zero(self, offset, length):
+        """Make a range of the output read back as zeros"""
+        self.punch = zero_range(self.fd, offset, length, self.zero_buf,
+                                self.punch)
+
+    def _copy(self, buf, infd, in_offset, out_offset, length, copy):
+        """Copy a range of an input to the output"""
+        if self.cfr and copy:
+            in_off = ctypes.c_longlong(in_offset)
+            out_off = ctypes.c_longlong(out_offset)
+            try:
+                while length > 0:
+                    ret = copy_file_range(infd, ctypes.byref(in_off), self.fd,
+                                          ctypes.byref(out_off), length, 0)
+                    if ret == 0:
+                        raise IOError(errno.EIO, "Unexpected end of input")
+                    length -= ret
+                    self.progress.update(ret)
+                return
+            except IOError as e:
+                if e.errno not in CFR_UNSUPPORTED:
+                    raise
+                # Fall back to pread/pwrite for the rest of the copy
+                self.cfr = False
+                in_offset = in_off.value
+                out_offset = out_off.value
+
+        while length > 0:
+            ret = pread(infd, buf, min(length, self.block_size), in_offset)
+            if ret == 0:
+                raise IOError(errno.EIO, "Unexpected end of input")
+            if copy and self.sparse and \
+                    is_zero(ctypes.string_at(buf, ret), self.zero):
+                self._zero(out_offset, ret)
+            elif copy:
+                pwrite_all(self.fd, buf, ret, out_offset)
+            self._hash(out_offset, buffer(buf, 0, ret), ret)
+            in_offset += ret
+            out_offset += ret
+            length -= ret
+            if copy:
+                self.progress.update(ret)
+
+
+class BackendCopier(object):
+    """Copies the data of source back-ends to a destination back-end using a
+    number of worker threads.
+
+    The data extents of the sources are split in ranges and every worker
+    copies one range at a time. The zero extents are discarded on the
+    destination. In sparse mode, the zero blocks of the data extents are
+    discarded too. If a back-end does not support random access, a single
+    worker copies the ranges in order. The extents of the sources are
+    requested while the copy proceeds, since the ones of sources that are
+    read in order may only be known after the preceding data are read.
+    """
+    def __init__(self, dst, progress, jobs, range_size, block_size, sparse):
+        self.dst = dst
+        self.progress = progress
+        self.jobs = jobs if dst.random_access else 1
+        self.range_size = range_size
+        self.block_size = block_size
+        self.sparse = sparse
+        self.zero = '\0' * block_size
+        self.sources = []
+        self.ranges = None
+        self.lock = threading.Lock()
+        self.error = None
+
+    def add(self, src, offset):
+        """Schedule the copy of a source back-end to the destination at the
+        given offset. Returns the size of the source."""
+        if not src.random_access:
+            self.jobs = 1
+        self.sources.append((src, offset))
+        return src.size()
+
+    def split(self):
+        """Generate the ranges to copy. Ranges with no source are discarded
+        on the destination."""
+        for src, offset in self.sources:
+            for start, length, is_data in src.extents():
+                if not is_data:
+                    yield None, start, offset + start, length
+                    continue
+                end = start + length
+                while start < end:
+                    length = min(self.range_size, end - start)
+                    yield src, start, offset + start, length
+                    start += length
+
+    def run(self):
+        """Perform the copy"""
+        self.ranges = self.split()
+        workers = [threading.Thread(target=self._worker)
+                   for _ in range(self.jobs)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # Joining without a timeout would block the SIGALRM handler that
+        # sends the progress messages.
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.5)
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+        self.dst.flush()
+
+    def _worker(self):
+        """Worker thread main loop"""
+        while self.error is None:
+            try:
+                with self.lock:
+                    task = next(self.ranges, None)
+                if task is None:
+                    return
+                src, in_offset, out_offset, length = task
+                if src is None:
+                    self.dst.discard(out_offset, length)
+                    self.progress.update(length)
+                else:
+                    self._copy(src, in_offset, out_offset, length)
+            except Exception:  # pylint: disable=broad-except
+                self.error = sys.exc_info()
+
+    def _copy(self, src, in_offset, out_offset, length):
+        """Copy a range of a source to the destination"""
+        while length > 0:
+            data = src.read_range(in_offset, min(length, self.block_size))
+            if not data:
+                raise IOError(errno.EIO, "Unexpected end of input")
+            if self.sparse and is_zero(data, self.zero):
+                self.dst.discard(out_offset, len(data))
+            else:
+                self.dst.write_range(out_offset, data)
+            in_offset += len(data)
+            out_offset += len(data)
+            length -= len(data)
+            self.progress.update(len(data))
+
+
+class OutputDestination(backendapi.Backend):
+    """Writes to a file descriptor, like the standard output. This is not a
+    back-end of its own.
+
+    If the descriptor refers to a regular file or a block device, it is
+    written randomly, starting at its current offset, and discarded ranges
+    are turned into holes, like SparseWriter does. Otherwise, it is written
+    in order and discarded ranges are filled with zeros.
+    """
+    target = 'dst'
+    name = 'output'
+
+    def __init__(self, fd, block_size):
+        self.url = "fd:%d" % fd
+        self.config = {}
+        self.fd = fd
+        self.random_access = is_seekable(fd)
+        self.start = os.lseek(fd, 0, os.SEEK_CUR) if self.random_access else 0
+        self.end = self.start
+        self.position = 0
+        self.zero = '\0' * block_size
+        self.zero_buf = ctypes.create_string_buffer(block_size)
+        self.punch = True
+        self.lock = threading.Lock()
+
+    def write_range(self, offset, data):
+        if self.random_access:
+            buf = ctypes.create_string_buffer(data, len(data))
+            pwrite_all(self.fd, buf, len(data), self.start + offset)
+            self._extend(offset + len(data))
+            return
+
+        if offset < self.position:
+            raise backendapi.BackendError("The output can only be written "
+                                          "in order")
+        while self.position < offset:
+            length = min(len(self.zero), offset - self.position)
+            write_all(self.fd, self.zero[:length])
+            self.position += length
+        write_all(self.fd, data)
+        self.position += len(data)
+
+    def discard(self, offset, length):
+        if self.random_access:
+            self.punch = zero_range(self.fd, self.start + offset, length,
+                                    self.zero_buf, self.punch)
+            self._extend(offset + length)
+        else:
+            self.write_range(offset + length, '')
+
+    def flush(self):
+        if self.random_access:
+            finalize_output(self.fd, self.end)
+
+    def _extend(self, end):
+        """Record that the output should extend up to end"""
+        with self.lock:
+            self.end = max(self.end, self.start + end)
+
+
+def clone_file(infd, outfd, offset):
+    """Make the output share the extents of the whole input file at the given
+    offset, using the FICLONERANGE ioctl. Returns False if this is not
+    supported for this pair of files."""
+    # struct file_clone_range: src_fd, src_offset, src_length, dest_offset.
+    # A zero src_length means "up to the end of the source file".
+    arg = struct.pack('qQQQ', infd, 0, 0, offset)
+    try:
+        fcntl.ioctl(outfd, FICLONERANGE, arg)
+        return True
+    except IOError as e:
+        if e.errno in CLONE_UNSUPPORTED:
+            return False
+        raise
+
+
+def is_zero(data, zero):
+    """Check if a data block contains only zeros. `zero' is a string of zeros
+    at least as long as the block"""
+    if len(data) == len(zero):
+        return data == zero
+    return data == zero[:len(data)]
+
+
+def zero_range(fd, offset, length, zero_buf, punch=True):
+    """Make a region of a file descriptor read back as zeros.
+
+    If `punch' is True, this is done by punching a hole, otherwise zeros from
+    the `zero_buf' ctypes buffer are written to the region. Returns False if
+    hole punching turned out to be unsupported by the file descriptor.
+    """
+    if punch:
+        try:
+            fallocate(fd, FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE, offset,
+                      length)
+            return True
+        except IOError as e:
+            if e.errno == errno.EOPNOTSUPP:
+                punch = False
+            elif e.errno != errno.EINVAL:
+                raise
+            # On EINVAL (e.g. a misaligned range on a block device) fall
+            # back to writing zeros for this region only.
+
+    while length > 0:
+        chunk = min(length, len(zero_buf))
+        pwrite_all(fd, zero_buf, chunk, offset)
+        offset += chunk
+        length -= chunk
+
+    return punch
+
+
+def finalize_output(fd, size):
+    """Make sure the output has at least the given size and flush it to the
+    disk"""
+    info = os.fstat(fd)
+    if stat.S_ISREG(info.st_mode) and info.st_size < size:
+        os.ftruncate(fd, size)
+
+    # We don't use O_DIRECT like dd does. Flush the data before the helper
+    # VM accesses the disk.
+    os.fsync(fd)
+
+
+def pwrite_all(fd, buf, length, offset):
+    """Write the first `length' bytes of a ctypes buffer to a file descriptor
+    at the given offset"""
+    written = 0
+    while written < length:
+        written += pwrite(fd, ctypes.byref(buf, written), length - written,
+                          offset + written)
+
+
+def write_all(fd, data):
+    """Write a whole data buffer to a file descriptor"""
+    written = 0
+    while written < len(data):
+        written += os.write(fd, buffer(data, written))
+
+
+def read_full(fd, size):
+    """Read from a file descriptor until size bytes are read or EOF is hit"""
+    chunks = []
+    while size > 0:
+        data = os.read(fd, size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def is_pipe(fd):
+    """Check if a file descriptor refers to a pipe"""
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+def is_seekable(fd):
+    """Check if a file descriptor refers to a regular file or a block
+    device"""
+    mode = os.fstat(fd).st_mode
+    return stat.S_ISREG(mode) or stat.S_ISBLK(mode)
+
+
+def copy_splice(infd, outfd, buffer_size, progress, checksum=None):
+    """Copy data from infd to outfd using splice(2). One of the file
+    descriptors needs to be a pipe. If a Checksum is given, infd needs to be
+    a pipe, so that the data can be duplicated into the Checksum first."""
+    while checksum is not None:
+        length = checksum.tee(infd, buffer_size)
+        if length == 0:
+            return
+        while length > 0:
+            sent = splice(infd, outfd, length, SPLICE_F_MOVE)
+            if sent == 0:
+                return
+            length -= sent
+            progress.update(sent)
+
+    while True:
+        sent = splice(infd, outfd, buffer_size, SPLICE_F_MOVE)
+        if sent == 0:
+            break
+        progress.update(sent)
+
+
+def copy_rw(infd, outfd, buffer_size, progress, checksum=None):
+    """Copy data from infd to outfd using plain read(2) and write(2). The
+    data are passed to the Checksum, if one is given."""
+    while True:
+        data = os.read(infd, buffer_size)
+        if not data:
+            break
+        if checksum is not None:
+            checksum.feed(data)
+        write_all(outfd, data)
+        progress.update(len(data))
+
+
+def copy_sparse(infd, writer, buffer_size, checksum=None):
+    """Copy data from infd to a SparseWriter. If infd is a regular file, its
+    holes are skipped without being read. The data, including the zeros of
+    the holes, are passed to the Checksum, if one is given."""
+    if not stat.S_ISREG(os.fstat(infd).st_mode):
+        while True:
+            data = read_full(infd, buffer_size)
+            if not data:
+                break
+            if checksum is not None:
+                checksum.feed(data)
+            writer.write(data)
+        return
+
+    for offset, length, is_data in file_extents(infd):
+        if not is_data:
+            if checksum is not None:
+                checksum.feed_zeros(length)
+            writer.skip(length)
+            continue
+
+        os.lseek(infd, offset, os.SEEK_SET)
+        while length > 0:
+            data = read_full(infd, min(length, buffer_size))
+            if not data:
+                # The file was truncated while we were reading it
+                raise IOError(errno.EIO, "Unexpected end of input file")
+            if checksum is not None:
+                checksum.feed(data)
+            writer.write(data)
+            length -= len(data)
+
+
+def write_checksum(checksum, path):
+    """Write the checksum of the image to a file"""
+    with open(path, 'w') as f:
+        f.write("%s\n" % checksum.digest())
+
+
 def parse_arguments():
     """Parse input arguments"""
     description = \
@@ -142,6 +867,63 @@ def parse_arguments():
     parser.add_argument(
         "-t", "--total", type=int, dest="total", default=None, metavar="TOTAL",
         help="The overall number of bytes expected to be transferred")
+    parser.add_argument(
+        "-S", "--sparse", action="store_true", dest="sparse", default=False,
+        help="Do not write blocks that contain only zeros. Instead, seek over "
+        "them and punch holes on the output. This only has an effect if the "
+        "output is a regular file or a block device")
+    parser.add_argument(
+        "-j", "--jobs", type=int, dest="jobs", default=1,
+        help="Copy the data using JOBS parallel workers. This only has an "
+        "effect if the input FILEs and the output are regular files or "
+        "block devices")
+    parser.add_argument(
+        "-r", "--range-size", type=int, dest="range_size",
+        default=64 * 1024 * 1024, metavar="BYTES",
+        help="Size of the ranges the data are split into for the parallel "
+        "workers")
+    parser.add_argument(
+        "-c", "--clone", action="store_true", dest="clone", default=False,
+        help="If the output is a regular file, try to clone the input FILEs "
+        "into it (reflink) instead of copying their data. This only works "
+        "on file systems that support it, like XFS and Btrfs")
+    parser.add_argument(
+        "-f", "--format", dest="format", default="raw",
+        choices=("raw", "qcow2", "vmdk"),
+        help="The format of the image, which is the last input. If it is not "
+        "raw, the disk the image holds is copied, and the parts of the disk "
+        "that are not allocated in the image are discarded on the output "
+        "instead of being copied")
+    parser.add_argument(
+        "--checksum", nargs=2, dest="checksum", default=None,
+        metavar=("ALGORITHM", "FILE"),
+        help="Compute the checksum of the image while copying it and write "
+        "it to FILE. ALGORITHM is one of: %s" %
+        ", ".join(sorted(CHECKSUM_COMMANDS)))
+    parser.add_argument(
+        "--image-offset", type=int, dest="image_offset", default=0,
+        metavar="BYTES",
+        help="The image starts BYTES into the data, e.g. after an MBR. The "
+        "preceding data are not part of the checksum")
+    parser.add_argument(
+        "--source", nargs=2, dest="source", default=None,
+        metavar=("BACKEND", "ID"),
+        help="Append the image with ID of the source back-end executable "
+        "BACKEND to the input FILEs. The image is accessed through the "
+        "in-process implementation of the back-end, if there is one. "
+        "Requires --destination")
+    parser.add_argument(
+        "--destination", nargs=2, dest="destination", default=None,
+        metavar=("BACKEND", "URI"),
+        help="Write the data to the disk with URI of the destination "
+        "back-end executable BACKEND, instead of the standard output. The "
+        "disk is accessed through the in-process implementation of the "
+        "back-end, if there is one. The data are read from the input FILEs")
+    parser.add_argument(
+        "input", nargs="*", metavar="FILE",
+        help="Read the data from the concatenation of the FILEs instead of "
+        "the standard input. Holes in regular files are skipped without "
+        "being read in sparse mode")
 
     args = parser.parse_args()
 
@@ -155,14 +937,84 @@ def parse_arguments():
         parser.print_help()
         sys.exit(1)
 
+    if args.destination is None and args.source is not None:
+        sys.stderr.write("Fatal: Option '--source' requires "
+                         "'--destination'.\n")
+        parser.print_help()
+        sys.exit(1)
+
+    if args.checksum is not None and \
+            args.checksum[0] not in CHECKSUM_COMMANDS:
+        sys.stderr.write("Fatal: Unknown checksum algorithm: '%s'.\n" %
+                         args.checksum[0])
+        parser.print_help()
+        sys.exit(1)
+
+    if args.checksum is not None and (args.destination is not None or
+                                      args.format != 'raw'):
+        sys.stderr.write("Fatal: Option '--checksum' cannot be combined with "
+                         "'--destination' or '-f'.\n")
+        parser.print_help()
+        sys.exit(1)
+
+    if args.destination is not None and args.source is None and \
+            not args.input:
+        sys.stderr.write("Fatal: Option '--destination' requires input "
+                         "FILEs or '--source'.\n")
+        parser.print_help()
+        sys.exit(1)
+
     return args
 
 
+def copy_backends(args):
+    """Copy the input FILEs, or the standard input, and the image of the
+    source back-end, if any, to the destination back-end, or the standard
+    output. If the image, which is the last input, is not raw, the disk it
+    holds is copied instead"""
+    sources = [backendapi.FileSource(name) for name in args.input]
+    dst = None
+    try:
+        if args.source is not None:
+            sources.append(backendapi.load_backend('src', *args.source))
+        elif not sources:
+            sources.append(backendapi.StreamSource(sys.stdin))
+        sources[-1] = diskimage.open_image(args.format, sources[-1])
+        if args.destination is not None:
+            dst = backendapi.load_backend('dst', *args.destination)
+        else:
+            dst = OutputDestination(sys.stdout.fileno(), args.buffer_size)
+
+        progress = Progress(args.out, args.interval, args.start, args.total)
+        copier = BackendCopier(dst, progress, args.jobs, args.range_size,
+                               args.buffer_size, args.sparse)
+        offset = 0
+        for src in sources:
+            offset += copier.add(src, offset)
+        if args.jobs > copier.jobs:
+            sys.stderr.write("A back-end does not support random access. "
+                             "Disabling parallel copy.\n")
+        copier.run()
+    except backendapi.BackendError as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    finally:
+        for backend in sources + [dst]:
+            if backend is not None:
+                backend.close()
+
+    progress.send_progress()
+    return 0
+
+
 def main():
     """ module entry point"""
     args = parse_arguments()
 
-    if os.isatty(sys.stdin.fileno()):
+    if args.destination is not None:
+        return copy_backends(args)
+
+    if not args.input and os.isatty(sys.stdin.fileno()):
         sys.stderr.write("Input is a tty. Expecting a pipe!\n")
         return 2
 
@@ -170,28 +1022,100 @@ def main():
         sys.stderr.write("Output is a tty. Expecting a pipe!\n")
         return 2
 
+    if args.format != 'raw':
+        return copy_backends(args)
+
     with open('/proc/sys/fs/pipe-max-size') as pipe_max_size:
-        max_size = pipe_max_size.read()
+        max_size = int(pipe_max_size.read())
 
     if max_size < args.buffer_size:
         args.buffer_size = max_size
 
     # Make the pipe size equal to the chunk size
-    fcntl.fcntl(sys.stdin.fileno(), F_SETPIPE_SZ, args.buffer_size)
-    fcntl.fcntl(sys.stdout.fileno(), F_SETPIPE_SZ, args.buffer_size)
+    for fd in sys.stdin.fileno(), sys.stdout.fileno():
+        if is_pipe(fd):
+            fcntl.fcntl(fd, F_SETPIPE_SZ, args.buffer_size)
+
+    outfd = sys.stdout.fileno()
+    if args.sparse and not is_seekable(outfd):
+        sys.stderr.write("Output is not seekable. Disabling sparse mode.\n")
+        args.sparse = False
+
+    # If all the input files and the output are seekable, the copy is
+    # performed by the workers of a ParallelCopier
+    modes = [os.stat(name).st_mode for name in args.input]
+    use_copier = modes and is_seekable(outfd) and \
+        all(stat.S_ISREG(m) or stat.S_ISBLK(m) for m in modes)
+
+    if args.jobs > 1 and not use_copier:
+        sys.stderr.write("Input or output is not seekable. Disabling "
+                         "parallel copy.\n")
+
+    checksum = None
+    try:
+        if args.checksum is not None:
+            checksum = Checksum(args.checksum[0], skip=args.image_offset,
+                                pipe_size=args.buffer_size)
+    except OSError as e:
+        sys.stderr.write("%s\n" % e.strerror)
+        return 1
 
     progress = Progress(args.out, args.interval, args.start, args.total)
 
-    while True:
-        sent = splice(sys.stdin.fileno(), sys.stdout.fileno(),
-                      args.buffer_size, SPLICE_F_MOVE)
-        if sent < 0:
-            return 3
-        elif sent == 0:
-            break
-        else:
-            progress.update(sent)
+    if use_copier:
+        copier = ParallelCopier(outfd, progress, args.jobs, args.range_size,
+                                args.buffer_size, args.sparse, checksum)
+        offset = os.lseek(outfd, 0, os.SEEK_CUR)
+        infds = [os.open(name, os.O_RDONLY) for name in args.input]
+        try:
+            for name, infd in zip(args.input, infds):
+                size = os.lseek(infd, 0, os.SEEK_END)
+                if args.clone and stat.S_ISREG(os.fstat(outfd).st_mode) and \
+                        clone_file(infd, outfd, offset):
+                    sys.stderr.write("Cloned file: %s\n" % name)
+                    progress.update(size)
+                    # No data were copied. They are read to be hashed.
+                    copier.add(infd, offset, size, copy=False)
+                else:
+                    copier.add(infd, offset, size)
+                offset += size
+            copier.run()
+        finally:
+            for infd in infds:
+                os.close(infd)
+        finalize_output(outfd, offset)
+        if checksum is not None:
+            write_checksum(checksum, args.checksum[1])
+        progress.send_progress()
+        return 0
+
+    writer = SparseWriter(outfd, progress, args.buffer_size) \
+        if args.sparse else None
+
+    for name in args.input or [None]:
+        infd = sys.stdin.fileno() if name is None else os.open(name,
+                                                               os.O_RDONLY)
+        try:
+            # Spliced data can only be passed to the Checksum if they are
+            # read from a pipe
+            if writer is not None:
+                copy_sparse(infd, writer, args.buffer_size, checksum)
+            elif is_pipe(infd) or is_pipe(outfd) and checksum is None:
+                copy_splice(infd, outfd, args.buffer_size, progress,
+                            checksum)
+            else:
+                copy_rw(infd, outfd, args.buffer_size, progress, checksum)
+        finally:
+            if name is not None:
+                os.close(infd)
+
+    if writer is not None:
+        writer.close()
+    elif is_seekable(outfd):
+        finalize_output(outfd, os.lseek(outfd, 0, os.SEEK_CUR))
 
+    if checksum is not None:
+        write_checksum(checksum, args.checksum[1])
     progress.send_progress()
     return 0
 
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Filter that decompresses the images read from the source back-ends.
+
+The utility reads an image from its standard input and writes it to its
+standard output. If the image is compressed with zstd, xz or gzip, which is
+detected by its magic bytes, it is decompressed by the zstd, xz or pigz
+program. xz and pigz use multiple threads. The compressed and the
+decompressed data are relayed through pipes, so the memory used is bounded by
+the memory limit of the decompressor. Images that are not compressed are
+passed through unchanged.
+
+With -i, the utility prints the compression format of an image, which is one
+of `none', `zstd', `xz' and `gzip', and its uncompressed size, and exits.
+The size is -1 if the image does not record it. zstd frames may record the
+size of their content. The index of xz files records it, but it can only be
+read if the image is a local file.
+"""
+
+import sys
+import os
+import json
+import time
+import struct
+import optparse
+import threading
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
+
+import backendapi
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+MSG_TYPE = "image-decompress-progress"
+
+BUFSIZE = 1024 * 1024
+
+# The largest head of an image needed to detect its format and parse its
+# first zstd frame header
+HEAD_SIZE = 65536
+
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+XZ_MAGIC = '\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = 'YZ'
+# The gzip magic followed by the deflate method, the only one defined. Two
+# bytes alone are too likely to start a raw disk image.
+GZIP_MAGIC = '\x1f\x8b\x08'
+
+
+class FormatError(Exception):
+    pass
+
+
+def is_zstd_skippable(magic):
+    """zstd skippable frames have magic numbers 0x184D2A50 to 0x184D2A5F"""
+    return len(magic) == 4 and magic[1:] == '\x2a\x4d\x18' and \
+        ord(magic[0]) & 0xf0 == 0x50
+
+
+def detect(head):
+    """Returns the compression format of the data that start with head"""
+    if head.startswith(ZSTD_MAGIC) or is_zstd_skippable(head[:4]):
+        return 'zstd'
+    elif head.startswith(XZ_MAGIC):
+        return 'xz'
+    elif head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    return 'none'
+
+
+def zstd_frame_header(header):
+    """Parses the header of a zstd frame. Returns the content size it records
+    or None, whether the frame has a checksum and the length of the header"""
+    if len(header) < 6:
+        raise FormatError("Truncated zstd frame header")
+    descriptor = ord(header[4])
+    single_segment = (descriptor >> 5) & 1
+    checksum = bool((descriptor >> 2) & 1)
+    dict_id_size = (0, 1, 2, 4)[descriptor & 3]
+    content_size_size = (single_segment, 2, 4, 8)[descriptor >> 6]
+
+    offset = 5 + (1 - single_segment) + dict_id_size
+    if content_size_size == 0:
+        return None, checksum, offset
+
+    field = header[offset:offset + content_size_size]
+    if len(field) < content_size_size:
+        raise FormatError("Truncated zstd frame header")
+    content_size = struct.unpack(
+        {1: '<B', 2: '<H', 4: '<I', 8: '<Q'}[content_size_size], field)[0]
+    if content_size_size == 2:
+        content_size += 256
+    return content_size, checksum, offset + content_size_size
+
+
+def zstd_head_content_size(head):
+    """Returns the content size the first zstd frame of a stream records, or
+    -1. Streams made of many frames (e.g. by pzstd) start with a skippable
+    frame and their size cannot be known from their head."""
+    if is_zstd_skippable(head[:4]):
+        return -1
+    content_size, _, _ = zstd_frame_header(head[:18])
+    return -1 if content_size is None else content_size
+
+
+def zstd_file_content_size(f, size):
+    """Returns the sum of the content sizes the zstd frames of a file record,
+    or -1 if a frame does not record it"""
+    total = 0
+    pos = 0
+    while pos < size:
+        f.seek(pos)
+        magic = f.read(4)
+        if is_zstd_skippable(magic):
+            pos += 8 + struct.unpack('<I', f.read(4))[0]
+            continue
+        if magic != ZSTD_MAGIC:
+            raise FormatError("Invalid zstd frame at offset %d" % pos)
+
+        content_size, checksum, length = zstd_frame_header(magic + f.read(14))
+        if content_size is None:
+            return -1
+        total += content_size
+        pos += length
+
+        # Skip the blocks of the frame
+        while True:
+            f.seek(pos)
+            header = f.read(3)
+            if len(header) < 3:
+                raise FormatError("Truncated zstd frame")
+            value = struct.unpack('<I', header + '\0')[0]
+            block_type = (value >> 1) & 3
+            # The content of RLE blocks is a single byte
+            pos += 3 + (1 if block_type == 1 else value >> 3)
+            if value & 1:
+                break
+        if checksum:
+            pos += 4
+    return total
+
+
+def xz_varint(data, offset):
+    """Decodes a variable-length integer of an xz index"""
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise FormatError("Truncated xz index")
+        byte = ord(data[offset])
+        value |= (byte & 0x7f) << shift
+        offset += 1
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def xz_file_content_size(f, size):
+    """Returns the uncompressed size of an xz file, out of the indexes of its
+    streams. The streams are walked from the end of the file."""
+    total = 0
+    pos = size
+    while pos > 0:
+        # Streams may be followed by padding
+        f.seek(pos - 4)
+        if f.read(4) == '\0' * 4:
+            pos -= 4
+            continue
+
+        f.seek(pos - 12)
+        footer = f.read(12)
+        if footer[10:] != XZ_FOOTER_MAGIC:
+            raise FormatError("Invalid xz stream footer")
+        index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        index_start = pos - 12 - index_size
+
+        f.seek(index_start)
+        index = f.read(index_size)
+        if index[:1] != '\0':
+            raise FormatError("Invalid xz index")
+        records, offset = xz_varint(index, 1)
+        blocks_size = 0
+        for _ in range(records):
+            unpadded, offset = xz_varint(index, offset)
+            uncompressed, offset = xz_varint(index, offset)
+            blocks_size += (unpadded + 3) & ~3
+            total += uncompressed
+
+        pos = index_start - blocks_size - 12
+        f.seek(max(pos, 0))
+        if pos < 0 or f.read(6) != XZ_MAGIC:
+            raise FormatError("Invalid xz stream header")
+    return total
+
+
+class SourceFile(object):
+    """File object that reads a back-end source with range requests. Reads
+    that fall in the given head of the image are served from it."""
+
+    def __init__(self, source, head):
+        if not source.random_access:
+            raise backendapi.NotSupported("The %s back-end cannot read the "
+                                          "image randomly" % source.name)
+        self.source = source
+        self.head = head
+        self.pos = 0
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, length):
+        if self.pos + length <= len(self.head):
+            data = self.head[self.pos:self.pos + length]
+        else:
+            data = self.source.read_range(self.pos, length)
+        self.pos += len(data)
+        return data
+
+
+def info(path=None, source=None):
+    """Returns the compression format and the uncompressed size of an image
+    hosted in a file or read from the standard input. If a back-end source is
+    given, only the head of the image is read from the standard input and the
+    rest of it from the source, with range requests. The frames of zstd
+    images are not walked in this case, since it would take a request for
+    every block."""
+    if path is None:
+        head = read_full(sys.stdin.fileno(), HEAD_SIZE)
+        if source is None:
+            fmt = detect(head)
+            return fmt, zstd_head_content_size(head) if fmt == 'zstd' else -1
+        f = SourceFile(source, head)
+        size = source.size()
+    else:
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(HEAD_SIZE)
+
+    fmt = detect(head)
+    if fmt == 'zstd' and source is not None:
+        return fmt, zstd_head_content_size(head)
+    elif fmt == 'zstd':
+        return fmt, zstd_file_content_size(f, size)
+    elif fmt == 'xz':
+        return fmt, xz_file_content_size(f, size)
+    return fmt, size if fmt == 'none' else -1
+
+
+class Progress(object):
+    """Sends progress messages about the compressed data read"""
+    def __init__(self, out, interval, total, fmt):
+        self.out = out
+        self.interval = interval
+        self.msg = {"type": MSG_TYPE, "format": fmt, "total": total,
+                    "position": 0}
+        self.last = time.time()
+
+    def update(self, val):
+        self.msg['position'] += val
+        if time.time() - self.last >= self.interval:
+            self.send()
+
+    def send(self):
+        if self.out is None:
+            return
+        total = self.msg['total']
+        self.msg['progress'] = float(0) if not total else \
+            float("%2.2f" % (self.msg['position'] * 100.0 / total))
+        self.msg['timestamp'] = time.time()
+        os.write(self.out, "%s\n" % json.dumps(self.msg))
+        self.last = time.time()
+
+
+def decompressor(fmt, jobs, memory):
+    """Returns the command that decompresses data of a format"""
+    if fmt == 'zstd':
+        return ['zstd', '-d', '-c', '-q', '--memory=%dMB' % memory]
+    elif fmt == 'xz':
+        return ['xz', '-d', '-c', '-q', '-T', str(jobs),
+                '--memlimit-decompress=%dMiB' % memory]
+    elif find_executable('pigz'):
+        return ['pigz', '-d', '-c', '-p', str(jobs)]
+    return ['gzip', '-d', '-c']
+
+
+def read_full(fd, size):
+    """Read from a file descriptor until size bytes are read or EOF is hit"""
+    chunks = []
+    while size > 0:
+        data = os.read(fd, size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def write_all(fd, data):
+    """Write a whole data buffer to a file descriptor"""
+    written = 0
+    while written < len(data):
+        written += os.write(fd, buffer(data, written))
+
+
+class Relay(threading.Thread):
+    """Copies the output of the decompressor to a file descriptor, making sure
+    it does not exceed the expected size"""
+    def __init__(self, process, outfd, expected):
+        threading.Thread.__init__(self)
+        self.process = process
+        self.outfd = outfd
+        self.expected = expected
+        self.size = 0
+        self.error = None
+
+    def run(self):
+        infd = self.process.stdout.fileno()
+        try:
+            while True:
+                data = os.read(infd, BUFSIZE)
+                if not data:
+                    break
+                self.size += len(data)
+                if self.expected >= 0 and self.size > self.expected:
+                    raise FormatError("The image is larger than its recorded "
+                                      "size: %d bytes" % self.expected)
+                write_all(self.outfd, data)
+        except (FormatError, OSError) as e:
+            self.error = e
+            # Make the decompressor and the process feeding it exit
+            self.process.kill()
+
+
+def decompress(infd, outfd, jobs, memory, progress, expected):
+    """Decompress the data read from infd and write them to outfd"""
+    head = read_full(infd, len(XZ_MAGIC))
+    fmt = detect(head)
+    progress.msg['format'] = fmt
+
+    if fmt == 'none':
+        data = head
+        while data:
+            write_all(outfd, data)
+            progress.update(len(data))
+            data = os.read(infd, BUFSIZE)
+        progress.send()
+        return
+
+    process = subprocess.Popen(decompressor(fmt, jobs, memory),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               close_fds=True)
+    relay = Relay(process, outfd, expected)
+    relay.daemon = True
+    relay.start()
+
+    try:
+        data = head
+        while data:
+            process.stdin.write(data)
+            progress.update(len(data))
+            data = os.read(infd, BUFSIZE)
+        process.stdin.close()
+    except IOError:
+        # The decompressor exited. Its exit code tells why.
+        pass
+
+    # Joining without a timeout cannot be interrupted in Python 2
+    while relay.is_alive():
+        relay.join(0.5)
+    ret = process.wait()
+
+    if relay.error is not None:
+        raise relay.error
+    if ret != 0:
+        raise FormatError("%s failed with exit code %d" %
+                          (decompressor(fmt, jobs, memory)[0], ret))
+    if expected >= 0 and relay.size != expected:
+        raise FormatError("The image is smaller than its recorded size: "
+                          "%d bytes" % expected)
+    progress.send()
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options]\n       %prog -i [FILE]\n" \
+        "       %prog -i --source BACKEND URL"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-i", "--info", action="store_true", dest="info",
+                      default=False,
+                      help="print the compression format and the "
+                      "uncompressed size of the image in FILE, or in the "
+                      "standard input, and exit")
+    parser.add_option("--source", type="string", nargs=2, dest="source",
+                      default=None, metavar="BACKEND URL",
+                      help="with -i, read the head of the image from the "
+                      "standard input and the rest of it with range requests "
+                      "through the in-process implementation of the source "
+                      "back-end BACKEND, which must support them")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=0,
+                      metavar="JOBS",
+                      help="decompress using up to JOBS threads. 0 means as "
+                      "many as the CPUs [default: %default]")
+    parser.add_option("-m", "--memory", type="int", dest="memory",
+                      default=1024, metavar="MB",
+                      help="fail if decompressing needs more than MB "
+                      "megabytes of memory [default: %default]")
+    parser.add_option("-s", "--size", type="int", dest="size", default=-1,
+                      metavar="BYTES",
+                      help="fail if the decompressed image is not BYTES "
+                      "bytes large")
+    parser.add_option("-o", "--output-fd", type="int", dest="out",
+                      default=None, metavar="FD",
+                      help="write progress messages to this file descriptor")
+    parser.add_option("-t", "--total", type="int", dest="total", default=0,
+                      metavar="BYTES",
+                      help="the size of the compressed image, for the "
+                      "progress messages")
+    parser.add_option("-I", "--interval", type="float", dest="interval",
+                      default=3, metavar="SECONDS",
+                      help="send a progress message every SECONDS seconds "
+                      "[default: %default]")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) > (1 if options.info and not options.source else 0):
+        parser.error('Wrong number of arguments')
+
+    if options.source and not options.info:
+        parser.error("Option `--source' requires `-i'")
+
+    if options.jobs < 0:
+        parser.error("The number of jobs cannot be negative")
+
+    if options.memory <= 0:
+        parser.error("The memory limit should be positive")
+
+    options.file = args[0] if args else None
+
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    try:
+        if options.info and options.source:
+            with backendapi.load_backend('src', *options.source) as source:
+                sys.stdout.write("%s %d\n" % info(source=source))
+            sys.exit(0)
+        elif options.info:
+            sys.stdout.write("%s %d\n" % info(options.file))
+            sys.exit(0)
+
+        jobs = options.jobs or multiprocessing.cpu_count()
+        progress = Progress(options.out, options.interval, options.total,
+                            'none')
+        decompress(sys.stdin.fileno(), sys.stdout.fileno(), jobs,
+                   options.memory, progress, options.size)
+    except (FormatError, backendapi.BackendError, OSError, IOError) as e:
+        sys.stderr.write("%s: %s\n" % (PROGNAME, e))
+        sys.exit(1)
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
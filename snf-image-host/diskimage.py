@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Readers of the disk held in qcow2 and VMDK images.
+
+The readers wrap the back-end object of backendapi.py that reads an image and
+give access to the disk it holds through the same methods. The extents of the
+disk that are not allocated in the image, or that are marked as zero, are
+reported as holes, so they are never read or written by copy-monitor.py.
+
+qcow2 images are read through their L1 and L2 tables. Standard, zero and
+zlib-compressed clusters are supported, but backing files, encryption,
+external data files and subclusters are not. If the image cannot be accessed
+randomly, it is first copied into a temporary file.
+
+Only stream-optimized VMDK images are supported. They are read in order,
+by following the markers of their compressed grains, so they can be streamed.
+
+With -i, the utility prints the format of an image, which is one of `raw',
+`qcow2' and `vmdk', and the size of the disk it holds, and exits. The size of
+a raw image read from the standard input is -1.
+"""
+
+import sys
+import os
+import zlib
+import struct
+import optparse
+import tempfile
+import threading
+
+import backendapi
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+# The largest header of the supported formats
+HEADER_SIZE = 512
+
+SECTOR_SIZE = 512
+
+QCOW2_MAGIC = 'QFI\xfb'
+QCOW2_HEADER = '>4sIQIIQIIQQIIQ'
+QCOW2_V3_HEADER = '>QQQII'
+QCOW2_V3_HEADER_LENGTH = 104
+
+# Incompatible features of qcow2 version 3
+QCOW2_INCOMPAT_DIRTY = 1 << 0
+QCOW2_INCOMPAT_CORRUPT = 1 << 1
+QCOW2_INCOMPAT_DATA_FILE = 1 << 2
+QCOW2_INCOMPAT_COMPRESSION = 1 << 3
+QCOW2_INCOMPAT_EXTL2 = 1 << 4
+
+QCOW2_COMPRESSION_ZLIB = 0
+
+# Bits of the L1 and L2 table entries
+QCOW2_OFLAG_COMPRESSED = 1 << 62
+QCOW2_OFLAG_ZERO = 1 << 0
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+
+# The kinds of qcow2 clusters
+ZERO, DATA, COMPRESSED = range(3)
+
+VMDK_MAGIC = 'KDMV'
+VMDK_HEADER = '<4sIIQQQQIQQQB4sH'
+VMDK_FLAG_COMPRESSED = 1 << 16
+VMDK_FLAG_MARKERS = 1 << 17
+VMDK_COMPRESSION_DEFLATE = 1
+
+# The types of the VMDK metadata markers
+VMDK_MARKER_EOS = 0
+VMDK_MARKER_FOOTER = 3
+
+
+class ImageError(backendapi.BackendError):
+    pass
+
+
+def detect(head):
+    """Returns the format of the image that starts with head"""
+    if head.startswith(QCOW2_MAGIC):
+        return 'qcow2'
+    elif head.startswith(VMDK_MAGIC):
+        return 'vmdk'
+    return 'raw'
+
+
+def read_exact(source, offset, length, what):
+    """Read a range of a source that is expected to be complete"""
+    data = source.read_range(offset, length)
+    if len(data) != length:
+        raise ImageError("The image is truncated: unable to read the %s at "
+                         "offset %d" % (what, offset))
+    return data
+
+
+class DiskImage(backendapi.Backend):
+    """Base class of the image readers. This is not a back-end of its own.
+    Closing the reader closes the source it wraps."""
+    target = 'src'
+
+    def __init__(self, source):
+        self.url = source.url
+        self.config = {}
+        self.source = source
+
+    def size(self):
+        return self.virtual_size
+
+    def close(self):
+        self.source.close()
+
+
+class Qcow2Image(DiskImage):
+    """Reads the disk held in a qcow2 image. The source must support random
+    access."""
+    name = 'qcow2'
+
+    def __init__(self, source):
+        DiskImage.__init__(self, source)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.l2_tables = {}
+
+        header = read_exact(source, 0, QCOW2_V3_HEADER_LENGTH, "header")
+        (magic, version, backing_file_offset, _, self.cluster_bits,
+         self.virtual_size, crypt_method, l1_size, l1_table_offset, _, _, _,
+         _) = struct.unpack_from(QCOW2_HEADER, header)
+        if magic != QCOW2_MAGIC:
+            raise ImageError("The image is not a qcow2 image")
+        if version not in (2, 3):
+            raise ImageError("Unsupported qcow2 version: %d" % version)
+        self.version = version
+
+        if version == 3:
+            incompatible, _, _, _, header_length = struct.unpack_from(
+                QCOW2_V3_HEADER, header, struct.calcsize(QCOW2_HEADER))
+            if incompatible & QCOW2_INCOMPAT_COMPRESSION:
+                if header_length <= QCOW2_V3_HEADER_LENGTH or ord(read_exact(
+                        source, QCOW2_V3_HEADER_LENGTH, 1, "header")) != \
+                        QCOW2_COMPRESSION_ZLIB:
+                    raise ImageError("Only zlib compressed qcow2 images are "
+                                     "supported")
+            if incompatible & QCOW2_INCOMPAT_CORRUPT:
+                raise ImageError("The qcow2 image is marked as corrupt")
+            if incompatible & QCOW2_INCOMPAT_DATA_FILE:
+                raise ImageError("qcow2 images with an external data file "
+                                 "are not supported")
+            if incompatible & QCOW2_INCOMPAT_EXTL2:
+                raise ImageError("qcow2 images with subclusters are not "
+                                 "supported")
+            if incompatible & ~(QCOW2_INCOMPAT_DIRTY |
+                                QCOW2_INCOMPAT_COMPRESSION):
+                raise ImageError("The qcow2 image uses unknown features")
+
+        if backing_file_offset:
+            raise ImageError("qcow2 images with a backing file are not "
+                             "supported")
+        if crypt_method:
+            raise ImageError("Encrypted qcow2 images are not supported")
+        if not 9 <= self.cluster_bits <= 21:
+            raise ImageError("Invalid qcow2 cluster size: 2^%d" %
+                             self.cluster_bits)
+
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.clusters = (self.virtual_size + self.cluster_size - 1) >> \
+            self.cluster_bits
+        if l1_size * self.l2_entries < self.clusters:
+            raise ImageError("The qcow2 L1 table is too small")
+        l1_size = (self.clusters + self.l2_entries - 1) // self.l2_entries
+        self.l1_table = struct.unpack(
+            '>%dQ' % l1_size, read_exact(source, l1_table_offset, l1_size * 8,
+                                         "L1 table"))
+
+        # The layout of compressed cluster descriptors
+        self.csize_shift = 62 - (self.cluster_bits - 8)
+        self.csize_mask = (1 << (self.cluster_bits - 8)) - 1
+        self.coffset_mask = (1 << self.csize_shift) - 1
+
+    def l2_table(self, index):
+        """Returns the L2 table with the given index in the L1 table, or None
+        if it is not allocated"""
+        offset = self.l1_table[index] & QCOW2_OFFSET_MASK
+        if not offset:
+            return None
+        with self.lock:
+            table = self.l2_tables.get(index)
+        if table is None:
+            table = read_exact(self.source, offset, self.cluster_size,
+                               "L2 table")
+            with self.lock:
+                self.l2_tables[index] = table
+        return table
+
+    def kind(self, entry):
+        """Returns the kind of the cluster an L2 entry describes"""
+        if entry & QCOW2_OFLAG_COMPRESSED:
+            return COMPRESSED
+        if self.version == 3 and entry & QCOW2_OFLAG_ZERO or \
+                not entry & QCOW2_OFFSET_MASK:
+            # Without a backing file, unallocated clusters read as zeros
+            return ZERO
+        return DATA
+
+    def cluster(self, index):
+        """Returns the kind of a cluster of the disk and its L2 entry"""
+        table = self.l2_table(index // self.l2_entries)
+        if table is None:
+            return ZERO, 0
+        entry, = struct.unpack_from('>Q', table,
+                                    (index % self.l2_entries) * 8)
+        return self.kind(entry), entry
+
+    def clusters_data(self):
+        """Generates the index of every cluster of the disk and whether it
+        holds data. The clusters of unallocated L2 tables are generated as
+        one."""
+        for l1_index in xrange(len(self.l1_table)):
+            first = l1_index * self.l2_entries
+            table = self.l2_table(l1_index)
+            if table is None:
+                yield first, False
+                continue
+            count = min(self.l2_entries, self.clusters - first)
+            for i, entry in enumerate(struct.unpack_from('>%dQ' % count,
+                                                         table)):
+                yield first + i, self.kind(entry) != ZERO
+
+    def extents(self):
+        start = 0
+        is_data = None
+        for index, data in self.clusters_data():
+            if data != is_data:
+                offset = index << self.cluster_bits
+                if offset > start:
+                    yield start, offset - start, is_data
+                start = offset
+                is_data = data
+        if self.virtual_size > start:
+            yield start, self.virtual_size - start, is_data
+
+    def compressed_cluster(self, entry):
+        """Returns the data of a compressed cluster"""
+        cached = getattr(self.local, 'cluster', None)
+        if cached is not None and cached[0] == entry:
+            return cached[1]
+
+        offset = entry & self.coffset_mask
+        sectors = ((entry >> self.csize_shift) & self.csize_mask) + 1
+        # The compressed data may end before the last sector
+        data = self.source.read_range(offset, sectors * SECTOR_SIZE -
+                                      offset % SECTOR_SIZE)
+        try:
+            cluster = zlib.decompressobj(-15).decompress(data,
+                                                         self.cluster_size)
+        except zlib.error as e:
+            raise ImageError("Corrupt compressed cluster at offset %d: %s" %
+                             (offset, e))
+        self.local.cluster = (entry, cluster)
+        return cluster
+
+    def read_range(self, offset, length):
+        length = max(0, min(length, self.virtual_size - offset))
+        chunks = []
+        while length > 0:
+            index = offset >> self.cluster_bits
+            start = offset & (self.cluster_size - 1)
+            kind, entry = self.cluster(index)
+            run = self.cluster_size - start
+            if kind == COMPRESSED:
+                chunk = self.compressed_cluster(entry)[start:start + length]
+                if len(chunk) < min(run, length):
+                    raise ImageError("Corrupt compressed cluster at offset "
+                                     "%d" % (entry & self.coffset_mask))
+                chunks.append(chunk)
+                offset += len(chunk)
+                length -= len(chunk)
+                continue
+
+            # Coalesce the following clusters that are zero or, for data
+            # clusters, contiguous in the image
+            host = (entry & QCOW2_OFFSET_MASK) + start
+            while run < length:
+                next_kind, next_entry = self.cluster(index + 1)
+                if next_kind != kind or kind == DATA and \
+                        next_entry & QCOW2_OFFSET_MASK != host + run:
+                    break
+                index += 1
+                run += self.cluster_size
+            run = min(run, length)
+
+            if kind == ZERO:
+                chunks.append('\0' * run)
+            else:
+                chunks.append(read_exact(self.source, host, run, "cluster"))
+            offset += run
+            length -= run
+        return ''.join(chunks)
+
+
+class VmdkImage(DiskImage):
+    """Reads the disk held in a stream-optimized VMDK image. The image is
+    read in order, so the disk can only be accessed by one thread at a time.
+    Its extents are generated while the image is being read: each data
+    extent is a grain, which should be read before the next extent is
+    requested."""
+    name = 'vmdk'
+    random_access = False
+
+    def __init__(self, source):
+        DiskImage.__init__(self, source)
+        header = read_exact(source, 0, SECTOR_SIZE, "header")
+        (magic, _, flags, capacity, self.grain_size, _, _, _, _, _, overhead,
+         _, _, compression) = struct.unpack_from(VMDK_HEADER, header)
+        if magic != VMDK_MAGIC:
+            raise ImageError("The image is not a VMDK image")
+        if not flags & VMDK_FLAG_COMPRESSED or \
+                not flags & VMDK_FLAG_MARKERS or \
+                compression != VMDK_COMPRESSION_DEFLATE:
+            raise ImageError("Only stream-optimized VMDK images are "
+                             "supported")
+        if not self.grain_size:
+            raise ImageError("Invalid VMDK grain size: 0")
+
+        self.virtual_size = capacity * SECTOR_SIZE
+        self.position = overhead * SECTOR_SIZE
+        self.grain = (0, '')
+
+    def marker(self):
+        """Reads the marker at the current position of the image. Returns
+        the disk offset of its grain and the compressed grain, or None and
+        the marker type for metadata markers. The position moves past the
+        marker and its data."""
+        marker = self.source.read_range(self.position, 12)
+        if not marker:
+            # The end-of-stream marker is missing
+            return None, VMDK_MARKER_EOS
+        if len(marker) < 12:
+            raise ImageError("The image is truncated at offset %d" %
+                             self.position)
+
+        value, size = struct.unpack('<QI', marker)
+        if size == 0:
+            # Metadata markers take a sector and are followed by value
+            # sectors of metadata
+            kind, = struct.unpack('<I', read_exact(
+                self.source, self.position + 12, 4, "marker"))
+            self.position += (value + 1) * SECTOR_SIZE
+            return None, kind
+
+        data = read_exact(self.source, self.position + 12, size, "grain")
+        self.position += (12 + size + SECTOR_SIZE - 1) // SECTOR_SIZE * \
+            SECTOR_SIZE
+        return value * SECTOR_SIZE, data
+
+    def extents(self):
+        grain_bytes = self.grain_size * SECTOR_SIZE
+        start = 0
+        while True:
+            offset, data = self.marker()
+            if offset is None:
+                if data in (VMDK_MARKER_EOS, VMDK_MARKER_FOOTER):
+                    break
+                continue
+            if offset < start or offset >= self.virtual_size:
+                raise ImageError("VMDK grain at disk offset %d is out of "
+                                 "order" % offset)
+            try:
+                grain = zlib.decompress(data)
+            except zlib.error as e:
+                raise ImageError("Corrupt VMDK grain at disk offset %d: %s" %
+                                 (offset, e))
+            length = min(grain_bytes, self.virtual_size - offset)
+            if len(grain) < length:
+                raise ImageError("Corrupt VMDK grain at disk offset %d" %
+                                 offset)
+
+            if offset > start:
+                yield start, offset - start, False
+            self.grain = (offset, grain[:length])
+            yield offset, length, True
+            start = offset + length
+
+        if self.virtual_size > start:
+            yield start, self.virtual_size - start, False
+
+    def read_range(self, offset, length):
+        grain_offset, grain = self.grain
+        if not grain_offset <= offset < grain_offset + len(grain):
+            raise ImageError("VMDK images can only be read in order")
+        start = offset - grain_offset
+        return grain[start:start + length]
+
+
+class SpooledFile(backendapi.FileSource):
+    """A temporary copy of an image that can only be read in order. The copy
+    is removed when it is closed."""
+    def __init__(self, source):
+        self.tmp = tempfile.NamedTemporaryFile(prefix='snf-image-')
+        backendapi.FileSource.__init__(self, self.tmp.name)
+        try:
+            offset = 0
+            while True:
+                data = source.read_range(offset, backendapi.CHUNK_SIZE)
+                if not data:
+                    break
+                self.tmp.write(data)
+                offset += len(data)
+            self.tmp.flush()
+        except (IOError, OSError) as e:
+            self.tmp.close()
+            raise ImageError("Unable to copy the image into a temporary "
+                             "file: %s" % e)
+        finally:
+            source.close()
+
+    def close(self):
+        backendapi.FileSource.close(self)
+        self.tmp.close()
+
+
+def open_image(fmt, source):
+    """Returns a reader of the disk held in the image of the given format
+    that the source reads"""
+    if fmt == 'raw':
+        return source
+    elif fmt == 'qcow2':
+        if not source.random_access:
+            source = SpooledFile(source)
+        return Qcow2Image(source)
+    elif fmt == 'vmdk':
+        return VmdkImage(source)
+    raise ImageError("Unknown image format: `%s'" % fmt)
+
+
+def info(source):
+    """Returns the format of the image the source reads and the size of the
+    disk it holds, which is recorded in the header of the image"""
+    head = source.read_range(0, HEADER_SIZE)
+    fmt = detect(head)
+    if fmt == 'raw':
+        try:
+            return fmt, source.size()
+        except backendapi.NotSupported:
+            return fmt, -1
+
+    if len(head) < 32:
+        raise ImageError("The header of the %s image is truncated" % fmt)
+    if fmt == 'qcow2':
+        size, = struct.unpack_from('>Q', head, 24)
+    else:
+        capacity, = struct.unpack_from('<Q', head, 12)
+        size = capacity * SECTOR_SIZE
+    return fmt, size
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog -i [FILE]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-i", "--info", action="store_true", dest="info",
+                      default=False,
+                      help="print the format of the image in FILE, or in the "
+                      "standard input, and the size of the disk it holds")
+
+    options, args = parser.parse_args(input_args)
+
+    if not options.info:
+        parser.error("Option `-i' is mandatory")
+
+    if len(args) > 1:
+        parser.error('Wrong number of arguments')
+
+    options.file = args[0] if args else None
+
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    if options.file is None:
+        source = backendapi.StreamSource(sys.stdin)
+    else:
+        source = backendapi.FileSource(options.file)
+
+    try:
+        sys.stdout.write("%s %d\n" % info(source))
+    except (backendapi.BackendError, OSError, IOError) as e:
+        sys.stderr.write("%s: %s\n" % (PROGNAME, e))
+        sys.exit(1)
+    finally:
+        source.close()
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
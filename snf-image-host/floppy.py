@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Utility that builds the image of the device hosting the helper rules.
+
+The utility writes an ext2 file system image holding the regular files and
+symbolic links found in a directory. The image is built in memory, so neither
+loop devices nor mounting are needed. Subdirectories are not supported.
+
+The file system has a single block group of 1KB blocks, which limits the
+image size to 8MB. The image is as large as requested, unless the files do not
+fit in it.
+"""
+
+import sys
+import os
+import stat
+import time
+import struct
+import optparse
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+BLOCK_SIZE = 1024
+INODE_SIZE = 128
+BLOCKS_PER_GROUP = 8 * BLOCK_SIZE
+# Each block of an inode holds 256 block numbers
+ADDRS_PER_BLOCK = BLOCK_SIZE // 4
+DIRECT_BLOCKS = 12
+
+ROOT_INO = 2
+LOST_FOUND_INO = 11
+
+EXT2_MAGIC = 0xEF53
+EXT2_FEATURE_INCOMPAT_FILETYPE = 0x2
+
+FT_REG_FILE = 1
+FT_DIR = 2
+FT_SYMLINK = 7
+
+# The first blocks of the file system: the boot block, the superblock, the
+# group descriptor table, the block bitmap and the inode bitmap
+SUPERBLOCK = 1
+GROUP_DESC = 2
+BLOCK_BITMAP = 3
+INODE_BITMAP = 4
+INODE_TABLE = 5
+
+
+class Ext2Error(Exception):
+    pass
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options] <directory> <image>"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-s", "--size", type="int", dest="size",
+                      default=1440, metavar="KB",
+                      help="make the image KB kilobytes large [default: "
+                      "%default]")
+    parser.add_option("-L", "--label", type="string", dest="label",
+                      default="", metavar="LABEL",
+                      help="set the volume label of the file system")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 2:
+        parser.error('Wrong number of arguments')
+
+    options.directory, options.image = args
+
+    return options
+
+
+def dir_entry(ino, name, file_type, rec_len=None):
+    """Returns a directory entry. If rec_len is missing, the entry is as short
+    as possible."""
+    if rec_len is None:
+        rec_len = dir_entry_len(name)
+    return struct.pack('<IHBB', ino, rec_len, len(name), file_type) + \
+        name + '\0' * (rec_len - 8 - len(name))
+
+
+def dir_entry_len(name):
+    return (8 + len(name) + 3) & ~3
+
+
+def dir_blocks(entries):
+    """Packs the (inode, name, file type) entries of a directory into
+    blocks"""
+    blocks = []
+    block = []
+    used = 0
+    for entry in entries:
+        length = dir_entry_len(entry[1])
+        if used + length > BLOCK_SIZE:
+            blocks.append(block)
+            block = []
+            used = 0
+        block.append(entry)
+        used += length
+    blocks.append(block)
+
+    data = ""
+    for block in blocks:
+        for entry in block[:-1]:
+            data += dir_entry(*entry)
+        # The last entry of a block spans the rest of it
+        ino, name, file_type = block[-1]
+        data += dir_entry(ino, name, file_type,
+                          BLOCK_SIZE - len(data) % BLOCK_SIZE)
+    return data
+
+
+def set_bits(bitmap, count):
+    """Marks the first count entries of a bitmap as used"""
+    for i in range(count):
+        bitmap[i // 8] |= 1 << (i % 8)
+
+
+class Ext2Image(object):
+    """An ext2 file system with a single, flat, root directory"""
+    def __init__(self, size, label=""):
+        if len(label) > 16:
+            raise Ext2Error("The volume label is longer than 16 characters")
+        self.size = size
+        self.label = label
+        self.files = []
+
+    def add_file(self, name, data):
+        self.add(name, stat.S_IFREG | 0o644, FT_REG_FILE, data)
+
+    def add_symlink(self, name, target):
+        self.add(name, stat.S_IFLNK | 0o777, FT_SYMLINK, target)
+
+    def add(self, name, mode, file_type, data):
+        if not name or '/' in name or len(name) > 255 or \
+                name in ('.', '..', 'lost+found'):
+            raise Ext2Error("Invalid file name: `%s'" % name)
+        if name in [f[0] for f in self.files]:
+            raise Ext2Error("File `%s' already exists" % name)
+        self.files.append((name, mode, file_type, data))
+
+    def build(self):
+        """Returns the contents of the image"""
+        now = int(time.time())
+
+        inodes_count = max(16, (LOST_FOUND_INO + len(self.files) + 7) & ~7)
+        next_block = [INODE_TABLE + inodes_count * INODE_SIZE // BLOCK_SIZE]
+        blocks = {}
+        inodes = {}
+
+        def allocate(data):
+            """Stores data in newly allocated blocks and returns their
+            numbers"""
+            numbers = []
+            for offset in range(0, len(data), BLOCK_SIZE):
+                blocks[next_block[0]] = data[offset:offset + BLOCK_SIZE]
+                numbers.append(next_block[0])
+                next_block[0] += 1
+            return numbers
+
+        def pointers(numbers):
+            return struct.pack('<%dI' % len(numbers), *numbers)
+
+        def inode(ino, mode, links, data, inline=False):
+            """Creates an inode holding data"""
+            i_block = [0] * 15
+            count = 0
+            if inline:
+                # A fast symbolic link stores its target in i_block
+                i_block = list(struct.unpack('<15I', data.ljust(60, '\0')))
+            else:
+                numbers = allocate(data)
+                count = len(numbers)
+                for i, number in enumerate(numbers[:DIRECT_BLOCKS]):
+                    i_block[i] = number
+                numbers = numbers[DIRECT_BLOCKS:]
+                if numbers:
+                    single = numbers[:ADDRS_PER_BLOCK]
+                    i_block[12], = allocate(pointers(single))
+                    count += 1
+                    numbers = numbers[ADDRS_PER_BLOCK:]
+                if numbers:
+                    if len(numbers) > ADDRS_PER_BLOCK ** 2:
+                        raise Ext2Error("File too large")
+                    singles = []
+                    for i in range(0, len(numbers), ADDRS_PER_BLOCK):
+                        singles += allocate(pointers(
+                            numbers[i:i + ADDRS_PER_BLOCK]))
+                    i_block[13], = allocate(pointers(singles))
+                    count += len(singles) + 1
+
+            inodes[ino] = struct.pack(
+                '<HHIIIIIHHII4x15I', mode, 0, len(data), now, now, now, 0,
+                0, links, count * (BLOCK_SIZE // 512), 0, *i_block)
+
+        root = [(ROOT_INO, '.', FT_DIR), (ROOT_INO, '..', FT_DIR),
+                (LOST_FOUND_INO, 'lost+found', FT_DIR)]
+        for ino, (name, mode, file_type, data) in \
+                enumerate(self.files, LOST_FOUND_INO + 1):
+            root.append((ino, name, file_type))
+            inode(ino, mode, 1, data,
+                  inline=file_type == FT_SYMLINK and len(data) < 60)
+        inode(ROOT_INO, stat.S_IFDIR | 0o755, 3, dir_blocks(root))
+        inode(LOST_FOUND_INO, stat.S_IFDIR | 0o700, 2,
+              dir_blocks([(LOST_FOUND_INO, '.', FT_DIR),
+                          (ROOT_INO, '..', FT_DIR)]))
+
+        blocks_count = max(self.size // BLOCK_SIZE, next_block[0])
+        if blocks_count - SUPERBLOCK > BLOCKS_PER_GROUP:
+            raise Ext2Error("The files do not fit in a single block group")
+        used_blocks = next_block[0] - SUPERBLOCK
+        used_inodes = LOST_FOUND_INO + len(self.files)
+
+        # The bits past the end of the group are set too
+        block_bitmap = bytearray(BLOCK_SIZE)
+        set_bits(block_bitmap, used_blocks)
+        for i in range(blocks_count - SUPERBLOCK, BLOCKS_PER_GROUP):
+            block_bitmap[i // 8] |= 1 << (i % 8)
+        inode_bitmap = bytearray(BLOCK_SIZE)
+        set_bits(inode_bitmap, used_inodes)
+        for i in range(inodes_count, BLOCK_SIZE * 8):
+            inode_bitmap[i // 8] |= 1 << (i % 8)
+
+        superblock = struct.pack(
+            '<13IHhHHHHIIIIHHIHHIII16s16s',
+            inodes_count, blocks_count, 0, blocks_count - SUPERBLOCK -
+            used_blocks, inodes_count - used_inodes, SUPERBLOCK, 0, 0,
+            BLOCKS_PER_GROUP, BLOCKS_PER_GROUP, inodes_count, 0, now,
+            0, -1, EXT2_MAGIC, 1, 1, 0, now, 0, 0, 1, 0, 0,
+            LOST_FOUND_INO, INODE_SIZE, 0, 0, EXT2_FEATURE_INCOMPAT_FILETYPE,
+            0, os.urandom(16), self.label)
+        group_desc = struct.pack(
+            '<IIIHHH', BLOCK_BITMAP, INODE_BITMAP, INODE_TABLE,
+            blocks_count - SUPERBLOCK - used_blocks,
+            inodes_count - used_inodes, 2)
+
+        image = bytearray(blocks_count * BLOCK_SIZE)
+
+        def write(offset, data):
+            image[offset:offset + len(data)] = data
+
+        write(SUPERBLOCK * BLOCK_SIZE, superblock)
+        write(GROUP_DESC * BLOCK_SIZE, group_desc)
+        write(BLOCK_BITMAP * BLOCK_SIZE, block_bitmap)
+        write(INODE_BITMAP * BLOCK_SIZE, inode_bitmap)
+        for ino, data in inodes.items():
+            write(INODE_TABLE * BLOCK_SIZE + (ino - 1) * INODE_SIZE, data)
+        for number, data in blocks.items():
+            write(number * BLOCK_SIZE, data)
+
+        return str(image)
+
+
+def image_from_directory(directory, size, label=""):
+    """Returns an image holding the files of a directory"""
+    image = Ext2Image(size, label)
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            image.add_symlink(name, os.readlink(path))
+        elif stat.S_ISREG(st.st_mode):
+            with open(path, 'rb') as f:
+                image.add_file(name, f.read())
+        else:
+            raise Ext2Error("`%s' is neither a regular file nor a symbolic "
+                            "link" % path)
+    return image.build()
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    try:
+        data = image_from_directory(options.directory, options.size * 1024,
+                                    options.label)
+        with open(options.image, 'wb') as f:
+            f.write(data)
+    except (Ext2Error, OSError, IOError) as e:
+        sys.stderr.write("%s: %s\n" % (PROGNAME, e))
+        sys.exit(1)
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -27,9 +27,12 @@ import os
 import time
 import json
 import re
+import errno
+import ctypes
+import struct
 import optparse
 import socket
-from scapy.all import sniff
+import subprocess
 
 LINESIZE = 512
 BUFSIZE = 512
@@ -38,6 +41,30 @@ STDERR_MAXLINES = 10
 MAXLINES = 100
 MSG_TYPE = 'image-helper'
 
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+PACKET_OUTGOING = 4
+SO_ATTACH_FILTER = 26
+IPPROTO = {'ip': None, 'tcp': 6, 'udp': 17}
+
+# Classic BPF opcodes
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+BPF_REJECT = 'reject'
+# Offsets in an Ethernet frame carrying an IPv4 packet
+ETH_TYPE = 12
+IP_FRAG = 20
+IP_PROTO = 23
+IP_SRC = 26
+IP_DST = 30
+
 PROTOCOL = {
     'TASK_START': ('task-start', 'task'),
     'TASK_END': ('task-end', 'task'),
@@ -59,6 +86,11 @@ def parse_options(input_args):
         help="add FILTER to incoming traffic when working on an interface",
         default=None, metavar="FILTER")
 
+    parser.add_option("-t", "--timeline", type="string", dest="timeline",
+                      default=None, metavar="FILE",
+                      help="record the first message and the duration of "
+                      "each task of the helper VM in the timeline FILE")
+
     options, args = parser.parse_args(input_args)
 
     if len(args) != 1:
@@ -78,9 +110,162 @@ def error(msg):
     sys.exit(1)
 
 
+def bpf_primitive(qualifier, keyword, value):
+    """Returns the BPF instructions that check a filter primitive. Jumps to
+    BPF_REJECT drop the packet."""
+    if keyword == 'host':
+        addr = struct.unpack('!I', socket.inet_aton(value))[0]
+        if qualifier is not None:
+            return [(BPF_LD_W_ABS, 0, 0,
+                     IP_SRC if qualifier == 'src' else IP_DST),
+                    (BPF_JEQ_K, 0, BPF_REJECT, addr)]
+        return [(BPF_LD_W_ABS, 0, 0, IP_SRC), (BPF_JEQ_K, 2, 0, addr),
+                (BPF_LD_W_ABS, 0, 0, IP_DST),
+                (BPF_JEQ_K, 0, BPF_REJECT, addr)]
+
+    if keyword == 'port':
+        port = int(value)
+        # Only the first fragment of a packet carries the ports
+        code = [(BPF_LD_H_ABS, 0, 0, IP_FRAG),
+                (BPF_JSET_K, BPF_REJECT, 0, 0x1fff),
+                (BPF_LDX_B_MSH, 0, 0, 14)]
+        if qualifier is not None:
+            return code + [(BPF_LD_H_IND, 0, 0,
+                            14 if qualifier == 'src' else 16),
+                           (BPF_JEQ_K, 0, BPF_REJECT, port)]
+        return code + [(BPF_LD_H_IND, 0, 0, 14), (BPF_JEQ_K, 2, 0, port),
+                       (BPF_LD_H_IND, 0, 0, 16),
+                       (BPF_JEQ_K, 0, BPF_REJECT, port)]
+
+    raise ValueError("Unsupported primitive: %s" % keyword)
+
+
+def compile_filter(expression):
+    """Compiles a filter expression to a classic BPF program for Ethernet
+    frames carrying IPv4 packets. Only conjunctions of the 'ip', 'udp', 'tcp',
+    '[src|dst] host ADDR' and '[src|dst] port PORT' primitives are supported.
+    Returns a list of (code, jt, jf, k) tuples."""
+    tokens = expression.replace('&&', ' and ').split()
+    checks = []
+    proto = None
+    ports = False
+    while tokens:
+        token = tokens.pop(0)
+        if token == 'and':
+            continue
+        if token in IPPROTO:
+            if token != 'ip':
+                proto = IPPROTO[token]
+            continue
+        qualifier = None
+        if token in ('src', 'dst'):
+            qualifier = token
+            token = tokens.pop(0) if tokens else None
+        if token not in ('host', 'port') or not tokens:
+            raise ValueError("Unable to parse filter: %s" % expression)
+        ports = ports or token == 'port'
+        checks.extend(bpf_primitive(qualifier, token, tokens.pop(0)))
+
+    code = [(BPF_LD_H_ABS, 0, 0, ETH_TYPE),
+            (BPF_JEQ_K, 0, BPF_REJECT, ETH_P_IP)]
+    if proto is not None:
+        code += [(BPF_LD_B_ABS, 0, 0, IP_PROTO),
+                 (BPF_JEQ_K, 0, BPF_REJECT, proto)]
+    elif ports:
+        code += [(BPF_LD_B_ABS, 0, 0, IP_PROTO),
+                 (BPF_JEQ_K, 1, 0, IPPROTO['tcp']),
+                 (BPF_JEQ_K, 0, BPF_REJECT, IPPROTO['udp'])]
+    code += checks
+    # Accept the whole packet
+    code.append((BPF_RET_K, 0, 0, 0x40000))
+    reject = len(code)
+    code.append((BPF_RET_K, 0, 0, 0))
+
+    return [(op, reject - i - 1 if jt == BPF_REJECT else jt,
+             reject - i - 1 if jf == BPF_REJECT else jf, k)
+            for i, (op, jt, jf, k) in enumerate(code)]
+
+
+def tcpdump_filter(expression):
+    """Compiles a filter expression to a classic BPF program using tcpdump"""
+    path = os.environ.get('PATH', '').split(':') + ['/usr/sbin', '/sbin']
+    for directory in path:
+        tcpdump = os.path.join(directory, 'tcpdump')
+        if os.access(tcpdump, os.X_OK):
+            break
+    else:
+        error("Filter needs tcpdump to be compiled: %s" % expression)
+
+    proc = subprocess.Popen([tcpdump, '-ddd', '-y', 'EN10MB', expression],
+                            stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        error("Unable to compile filter: %s" % expression)
+    # The first line is the number of instructions
+    return [tuple(int(x) for x in line.split())
+            for line in out.splitlines()[1:]]
+
+
+def attach_filter(sock, program):
+    """Attaches a classic BPF program to a socket"""
+    insns = ctypes.create_string_buffer(
+        ''.join(struct.pack('HBBI', *insn) for insn in program))
+    fprog = struct.pack('HL', len(program), ctypes.addressof(insns))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def udp_payload(frame):
+    """Returns the UDP payload of an Ethernet frame or None if the frame does
+    not carry a UDP over IPv4 packet"""
+    offset = 14
+    ethertype = struct.unpack_from('!H', frame, ETH_TYPE)[0]
+    if ethertype == ETH_P_8021Q:
+        offset += 4
+        ethertype = struct.unpack_from('!H', frame, ETH_TYPE + 4)[0]
+    if ethertype != ETH_P_IP or len(frame) < offset + 20:
+        return None
+
+    version_ihl = ord(frame[offset])
+    if version_ihl >> 4 != 4 or ord(frame[offset + 9]) != IPPROTO['udp']:
+        return None
+
+    udp = offset + (version_ihl & 0xf) * 4
+    if len(frame) < udp + 8:
+        return None
+    length = struct.unpack_from('!H', frame, udp + 4)[0]
+    return frame[udp + 8:udp + length]
+
+
+def capture(ifname, expression=None):
+    """Yields the UDP payloads of the packets received on an interface. If a
+    filter expression is given, the kernel drops the packets that do not match
+    it."""
+    # A packet socket with protocol 0 receives nothing until it is bound. This
+    # way no packet gets in before the filter is attached.
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    if expression is not None:
+        try:
+            program = compile_filter(expression)
+        except ValueError:
+            program = tcpdump_filter(expression)
+        attach_filter(sock, program)
+    sock.bind((ifname, ETH_P_ALL))
+
+    while True:
+        frame, addr = sock.recvfrom(65535)
+        if addr[2] == PACKET_OUTGOING:
+            continue
+        payload = udp_payload(frame)
+        if payload is not None:
+            yield payload
+
+
 class HelperMonitor(object):
-    def __init__(self, fd):
+    def __init__(self, fd, timeline=None):
         self.fd = fd
+        self.timeline = timeline
+        self.tasks = {}
+        self.first_message = True
         self.lines_left = 0
         self.line_count = 0
         self.stderr = ""
@@ -169,6 +354,27 @@ class HelperMonitor(object):
         msg['timestamp'] = time.time()
         os.write(self.fd, "%s\n" % json.dumps(msg))
 
+        if self.timeline is not None:
+            self.record(msg_type, value, msg['timestamp'])
+
+    def record(self, msg_type, value, timestamp):
+        """Record the stages of the helper VM in the timeline file"""
+        stages = []
+        if self.first_message:
+            self.first_message = False
+            stages.append(("helper-first-message", timestamp, timestamp))
+
+        if msg_type == 'TASK_START':
+            self.tasks[value] = timestamp
+        elif msg_type == 'TASK_END' and value in self.tasks:
+            stages.append(("task:%s" % value, self.tasks.pop(value),
+                           timestamp))
+
+        if stages:
+            with open(self.timeline, 'a') as f:
+                for stage in stages:
+                    f.write("%s\t%.9f\t%.9f\n" % stage)
+
 
 if __name__ == "__main__":
     options = parse_options(sys.argv[1:])
@@ -183,15 +389,15 @@ if __name__ == "__main__":
     except OSError:
         error("File descriptor is not valid")
 
-    monitor = HelperMonitor(fd)
+    monitor = HelperMonitor(fd, options.timeline)
 
     if options.ifname is not None:
         try:
-            sniff(filter=options.filter, iface=options.ifname,
-                  prn=lambda x: monitor.process(x.payload.getfieldval("load")))
+            for payload in capture(options.ifname, options.filter):
+                monitor.process(payload)
         except socket.error as e:
             # Network is down
-            if e.errno == 100:
+            if e.errno == errno.ENETDOWN:
                 monitor.process(None)
             else:
                 raise
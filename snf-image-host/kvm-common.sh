@@ -52,8 +52,318 @@ assign_disk_devices_to() {
     done
 }
 
+# Serial number of the device hosting the rules file, when the helper VM is
+# restored from its saved state
+HELPER_RULES_SERIAL="snf-image-rules"
+
+set_helper_args() {
+    # Set helper_args to the KVM arguments that define the helper VM. A saved
+    # state of the VM may only be restored on a VM with the same arguments.
+    # The arguments of the function are added to the kernel command line.
+    helper_args=(-runas "$HELPER_USER"
+      -drive file="$HELPER_DIR/image",format=raw,if=none,id=helper,readonly
+      -device virtio-blk-pci,id=helper,drive=helper
+      -m "$HELPER_MEMORY" -smp "$(helper_vcpus)" -boot c
+      -vga none -nographic -parallel none -monitor null
+      -kernel "$HELPER_DIR/kernel" -initrd "$HELPER_DIR/initrd"
+      -append "quiet ro root=/dev/vda console=ttyS0,9600n8 hypervisor=kvm \
+             snf_image_activate_helper $* init=/usr/bin/snf-image-helper")
+}
+
+helper_waiting_args() {
+    # Print the kernel command line arguments of a helper VM that waits for
+    # its disks and rules to be attached before it reads its rules. The state
+    # of such a VM may be saved and the VMs of the helper pool are such VMs.
+    echo "snf_image_snapshot rules_dev=/dev/disk/by-id/virtio-$HELPER_RULES_SERIAL"
+}
+
+helper_disk_queues() {
+    # Print the number of request queues of each disk of the instance
+    if [ "$HELPER_DISK_QUEUES" = "auto" ]; then
+        helper_vcpus
+    else
+        echo "$HELPER_DISK_QUEUES"
+    fi
+}
+
+helper_disk_props() {
+    # Print the properties of a virtio device that set its number of queues
+    # and its iothread. The first argument is the name of the property that
+    # sets the number of queues and the second one the index of the iothread.
+    local queues
+
+    queues=$(helper_disk_queues)
+    if [ "$queues" -gt 1 ]; then
+        echo -n ",$1=$queues"
+    fi
+    if [ "$HELPER_DISK_IOTHREADS" = "yes" ]; then
+        echo -n ",iothread=iothread$2"
+    fi
+}
+
+helper_snapshot_info() {
+    # Print what the saved state of the helper VM depends on. The state may
+    # only be restored if none of these has changed since it was saved.
+    echo "memory=$HELPER_MEMORY"
+    echo "vcpus=$(helper_vcpus)"
+    $KVM --version | head -1
+    stat -c "%n %s %Y" "$HELPER_DIR"/{kernel,initrd,image}
+}
+
+helper_snapshot_usable() {
+    # Check if the helper VM of this deployment may be restored from its
+    # saved state
+    if [ "$HELPER_SNAPSHOT" != "yes" -o "x$HELPER_DEBUG" = "xyes" ]; then
+        return 1
+    fi
+
+    if [ ! -f "$HELPER_DIR/snapshot" ] || [ "$(helper_snapshot_info)" != \
+            "$(cat "$HELPER_DIR/snapshot.info" 2> /dev/null)" ]; then
+        log_warning "The saved state of the helper VM is missing or out of" \
+            "date. Run \`snf-image-update-helper -s' to save it again."
+        return 1
+    fi
+
+    return 0
+}
+
+create_helper_snapshot() {
+    local state result qmp pid i
+
+    state=$(mktemp "$HELPER_DIR/snapshot.XXXXXX")
+    add_cleanup rm -f "$state"
+    result=$(mktemp --tmpdir result.XXXXXX)
+    add_cleanup rm -f "$result"
+    qmp=$(mktemp -u --tmpdir qmp.XXXXXX)
+    add_cleanup rm -f "$qmp"
+
+    # QEMU saves the state after it has dropped its privileges
+    chown "$HELPER_USER" "$state"
+
+    set_helper_args "$(helper_waiting_args)"
+    $TIMEOUT -k "$HELPER_HARD_TIMEOUT" "$HELPER_SOFT_TIMEOUT" \
+      $KVM "${helper_args[@]}" \
+      -serial null -serial "file:$result" -serial null -serial null \
+      -qmp "unix:$qmp,server,nowait" &
+    pid=$!
+
+    # The helper sends READY right before it starts waiting for its rules
+    for ((i = 0; i < HELPER_SOFT_TIMEOUT * 10; i++)); do
+        if grep -q READY "$result" || ! kill -0 "$pid" 2> /dev/null; then
+            break
+        fi
+        sleep 0.1
+    done
+
+    if ! grep -q READY "$result"; then
+        log_error "The helper VM did not get ready to read its rules"
+        suppress_errors kill "$pid"
+        wait "$pid" || true
+        return 1
+    fi
+
+    ./qmp.py "$qmp" > /dev/null <<EOF
+stop
+migrate {"uri": "exec:cat > $state"}
+quit
+EOF
+    wait "$pid" || true
+
+    chown --reference="$HELPER_DIR" "$state"
+    chmod 644 "$state"
+    mv "$state" "$HELPER_DIR/snapshot"
+    helper_snapshot_info > "$HELPER_DIR/snapshot.info"
+}
+
+resume_helper() {
+    # Attach the disks of the instance and the device hosting the rules to a
+    # helper VM that waits for them and resume it. Any extra arguments are
+    # QMP commands to run first.
+    local qmp="$1" floppy="$2" i queues props
+    shift 2
+
+    queues=$(helper_disk_queues)
+    {
+        for cmd; do
+            echo "$cmd"
+        done
+        for ((i = 0; i < DISK_COUNT; i++)); do
+            props=""
+            if [ "$queues" -gt 1 ]; then
+                props+=", \"num-queues\": $queues"
+            fi
+            if [ "$HELPER_DISK_IOTHREADS" = "yes" ]; then
+                echo "object-add {\"qom-type\": \"iothread\", \"id\": \"iothread$i\"}"
+                props+=", \"iothread\": \"iothread$i\""
+            fi
+            echo "human-monitor-command {\"command-line\": \"drive_add 0" \
+                "file=${DISK_PATH[$i]},format=raw,if=none,cache=none,aio=$HELPER_DISK_AIO,id=drive$i\"}"
+            echo "device_add {\"driver\": \"virtio-blk-pci\"," \
+                "\"id\": \"disk$i\", \"drive\": \"drive$i\"$props}"
+        done
+        echo "human-monitor-command {\"command-line\": \"drive_add 0" \
+            "file=$floppy,format=raw,if=none,id=rules\"}"
+        echo "device_add {\"driver\": \"virtio-blk-pci\", \"id\": \"rules\"," \
+            "\"drive\": \"rules\", \"serial\": \"$HELPER_RULES_SERIAL\"}"
+        echo "cont"
+    } | ./qmp.py -t "$HELPER_SOFT_TIMEOUT" "$qmp" > /dev/null
+}
+
+pool_vm_alive() {
+    # Check if the VM of a helper pool directory is running
+    local pid
+
+    pid=$(cat "$1/pid" 2> /dev/null) && kill -0 "$pid" 2> /dev/null
+}
+
+destroy_pool_vm() {
+    # Kill the VM of a helper pool directory and remove the directory
+    local vm="$1"
+
+    if pool_vm_alive "$vm"; then
+        kill "$(cat "$vm/pid")"
+    fi
+    rm -rf "$vm"
+}
+
+spawn_pool_vm() {
+    # Start an idle helper VM in the helper pool. The VM waits for its disks
+    # and rules and its serial ports are UNIX sockets in its directory.
+    local vm chardev
+
+    vm=$(mktemp -d "$HELPER_POOL_DIR/new.XXXXXX")
+
+    set_helper_args "$(helper_waiting_args)"
+    if helper_snapshot_usable; then
+        helper_args+=(-incoming "exec:cat $(printf "%q" "$HELPER_DIR/snapshot")")
+    fi
+    for chardev in console result monitor; do
+        helper_args+=(-chardev "socket,id=$chardev,path=$vm/$chardev,server,nowait"
+            -serial "chardev:$chardev")
+    done
+
+    if ! $KVM "${helper_args[@]}" -serial null \
+            -qmp "unix:$vm/qmp,server,nowait" -daemonize -pidfile "$vm/pid"; then
+        rm -rf "$vm"
+        return 1
+    fi
+
+    helper_snapshot_info > "$vm/info"
+    mv -T "$vm" "$HELPER_POOL_DIR/vm.${vm##*.}"
+}
+
+fill_helper_pool() {
+    # Start idle helper VMs until there are HELPER_POOL_SIZE of them in the
+    # pool, as long as HELPER_POOL_RESERVE megabytes of memory are left
+    # available on the node
+    local lock vm info count available
+
+    mkdir -p "$HELPER_POOL_DIR"
+    exec {lock}>> "$HELPER_POOL_DIR/lock"
+
+    # Someone else is filling the pool
+    if ! flock -n "$lock"; then
+        return 0
+    fi
+
+    # Leftovers of VMs that failed to start
+    rm -rf "$HELPER_POOL_DIR"/new.*
+
+    info=$(helper_snapshot_info)
+    count=0
+    for vm in "$HELPER_POOL_DIR"/{vm,claimed}.*; do
+        if [ ! -d "$vm" ]; then
+            continue
+        elif ! pool_vm_alive "$vm"; then
+            rm -rf "$vm"
+        elif [[ "$vm" =~ /vm\.[^/]*$ ]]; then
+            if [ "$(cat "$vm/info")" = "$info" ]; then
+                count=$((count + 1))
+            # Claim the VMs of an older helper to destroy them
+            elif mv -T "$vm" "$HELPER_POOL_DIR/claimed.${vm##*.}"; then
+                destroy_pool_vm "$HELPER_POOL_DIR/claimed.${vm##*.}"
+            fi
+        fi
+    done
+
+    while [ "$count" -lt "$HELPER_POOL_SIZE" ]; do
+        available=$($AWK '/^MemAvailable:/ { print int($2 / 1024) }' /proc/meminfo)
+        if [ $((available - HELPER_MEMORY)) -lt "$HELPER_POOL_RESERVE" ]; then
+            break
+        fi
+        # The VM must not inherit the lock
+        spawn_pool_vm {lock}>&- || break
+        count=$((count + 1))
+    done
+
+    close_fd "$lock"
+}
+
+claim_pool_vm() {
+    # Claim an idle VM of the helper pool and print its directory. The VMs
+    # that were started first are the most likely to have finished booting.
+    local vm claimed info
+
+    info=$(helper_snapshot_info)
+    for vm in $(ls -dtr "$HELPER_POOL_DIR"/vm.* 2> /dev/null); do
+        claimed="$HELPER_POOL_DIR/claimed.${vm##*.}"
+        # Only one of the deployments that try to claim the VM will succeed
+        if ! mv -T "$vm" "$claimed" 2> /dev/null; then
+            continue
+        fi
+
+        if pool_vm_alive "$claimed" && [ "$(cat "$claimed/info")" = "$info" ]; then
+            echo "$claimed"
+            return 0
+        fi
+        destroy_pool_vm "$claimed"
+    done
+
+    return 1
+}
+
+run_pool_helper() {
+    # Run the helper of this deployment on a VM of the helper pool and print
+    # its console. The VM exits once the helper finishes.
+    local vm="$1" floppy="$2" result_file="$3" result_pid monitor_pid rc
+
+    $SOCAT -u "UNIX-CONNECT:$vm/result" STDOUT > "$result_file" &
+    result_pid=$!
+    $SOCAT -u "UNIX-CONNECT:$vm/monitor" STDOUT |
+        ./helper-monitor.py ${TIMELINE:+-t "$TIMELINE"} ${MONITOR_FD} &
+    monitor_pid=$!
+
+    # Do not lose any output of the helper
+    {
+        if ! resume_helper "$vm/qmp" "$floppy" \
+                'wait-connected {"labels": ["console", "result", "monitor"]}'; then
+            log_error "Unable to attach the disks to the helper VM"
+            echo quit | suppress_errors ./qmp.py "$vm/qmp"
+        fi
+    } &
+
+    $TIMEOUT -k "$HELPER_HARD_TIMEOUT" "$HELPER_SOFT_TIMEOUT" \
+      $SOCAT -u "UNIX-CONNECT:$vm/console" STDOUT
+    rc=$?
+
+    if [ "$rc" -ne 0 ] && pool_vm_alive "$vm"; then
+        kill "$(cat "$vm/pid")"
+    fi
+    wait "$result_pid" "$monitor_pid"
+
+    return "$rc"
+}
+
+helper_waiting_usable() {
+    # Check if the helper VM of this deployment may be one that waits for its
+    # disks. Only virtio-blk disks may be attached to such a VM and its vCPUs
+    # are fixed before the disks of the instance are known.
+    [ "$disk_type" = "paravirtual" -a "x$HELPER_DEBUG" != "xyes" -a \
+        "$HELPER_VCPUS" != "auto" ]
+}
+
 launch_helper() {
-    local result_file result snapshot rc floppy i disks
+    local result_file result rc floppy i disks boot qmp vm
 
     floppy="$1"
 
@@ -62,52 +372,95 @@ launch_helper() {
 
     report_info "Starting customization VM..."
     echo "$($DATE +%Y:%m:%d-%H:%M:%S.%N) VM START" >&2
+    stage_begin helper-vm
 
-    disks=""
-    for ((i=0; i < DISK_COUNT; i++)); do
-        disks+=" -drive file=${DISK_PATH[$i]},format=raw,if=none,cache=none,id=drive$i"
-        disks+=" -device $(get_img_driver),id=disk$i,drive=drive$i"
-    done
+    if [ "$HELPER_POOL_SIZE" -gt 0 ] && helper_waiting_usable; then
+        vm=$(claim_pool_vm) || true
+        # Replace the VM of this deployment in the background. The filler
+        # and the VMs it starts outlive the deployment and must not hold the
+        # monitor pipe (MONITOR_FD) open.
+        ( close_fds; fill_helper_pool ) < /dev/null &> /dev/null &
+    fi
 
-    set +e
+    if [ -n "$vm" ]; then
+        boot=pool
+        add_cleanup destroy_pool_vm "$vm"
+    elif helper_waiting_usable && helper_snapshot_usable; then
+        boot=snapshot
+        qmp=$(mktemp -u --tmpdir qmp.XXXXXX)
+        add_cleanup rm -f "$qmp"
+
+        # Restore the VM paused and resume it once the disks are attached
+        set_helper_args "$(helper_waiting_args)"
+        helper_args+=(-S -qmp "unix:$qmp,server,nowait"
+            -incoming "exec:cat $(printf "%q" "$HELPER_DIR/snapshot")")
 
-    if [ "x$HELPER_DEBUG" = "xyes" ]; then
-        HELPER_DEBUG_ARG="snf_image_debug_helper"
+        {
+            if ! resume_helper "$qmp" "$floppy"; then
+                log_error "Unable to resume the helper VM"
+                echo quit | suppress_errors ./qmp.py "$qmp"
+            fi
+        } &
     else
-        HELPER_DEBUG_ARG=""
-    fi
+        boot=cold
+        disks=()
+        for ((i=0; i < DISK_COUNT; i++)); do
+            disks+=(-drive "file=${DISK_PATH[$i]},format=raw,if=none,cache=none,aio=$HELPER_DISK_AIO,id=drive$i")
+            if [[ "$disk_type" =~ ^scsi ]]; then
+                disks+=(-device "$(get_img_driver),id=disk$i,drive=drive$i")
+                continue
+            fi
+            disks+=(-device "$(get_img_driver),id=disk$i,drive=drive$i$(helper_disk_props num-queues $i)")
+            if [ "$HELPER_DISK_IOTHREADS" = "yes" ]; then
+                disks+=(-object "iothread,id=iothread$i")
+            fi
+        done
+
+        if [ "x$HELPER_DEBUG" = "xyes" ]; then
+            HELPER_DEBUG_ARG="snf_image_debug_helper"
+        else
+            HELPER_DEBUG_ARG=""
+        fi
+
+        # The disks share the queues and the iothread of the SCSI controller
+        if [[ "$disk_type" =~ ^scsi ]]; then
+            disks=(-device "virtio-scsi-pci$(helper_disk_props num_queues 0)"
+                "${disks[@]}")
+            if [ "$HELPER_DISK_IOTHREADS" = "yes" ]; then
+                disks+=(-object "iothread,id=iothread0")
+            fi
+        fi
 
-    if [[ "$disk_type" =~ ^scsi ]]; then
-        EXTRA_CONTROLLER_ARG="-device virtio-scsi-pci"
+        set_helper_args $HELPER_DEBUG_ARG rules_dev=/dev/fd0
+        helper_args+=("${disks[@]}"
+            -drive file="$floppy",if=floppy,format=raw)
     fi
 
-    $TIMEOUT -k "$HELPER_HARD_TIMEOUT" "$HELPER_SOFT_TIMEOUT" \
-      $KVM -runas "$HELPER_USER" \
-      -drive file="$HELPER_DIR/image",format=raw,if=none,id=helper,readonly \
-      -device virtio-blk-pci,id=helper,drive=helper \
-      $EXTRA_CONTROLLER_ARG $disks \
-      -m "$HELPER_MEMORY" -boot c -serial stdio \
-      -serial "file:$(printf "%q" "$result_file")" \
-      -serial file:>(./helper-monitor.py ${MONITOR_FD}) \
-      -serial pty \
-      -drive file="$floppy",if=floppy,format=raw \
-      -vga none -nographic -parallel none -monitor null \
-      -kernel "$HELPER_DIR/kernel" -initrd "$HELPER_DIR/initrd" \
-      -append "quiet ro root=/dev/vda console=ttyS0,9600n8 \
-             hypervisor=$HYPERVISOR snf_image_activate_helper \
-             $HELPER_DEBUG_ARG \
-	     rules_dev=/dev/fd0 init=/usr/bin/snf-image-helper" \
-      2>&1 | sed -u 's|^|HELPER: |g'
+    set +e
+
+    if [ "$boot" = "pool" ]; then
+        run_pool_helper "$vm" "$floppy" "$result_file" \
+          2>&1 | sed -u 's|^|HELPER: |g'
+    else
+        $TIMEOUT -k "$HELPER_HARD_TIMEOUT" "$HELPER_SOFT_TIMEOUT" \
+          $KVM "${helper_args[@]}" -serial stdio \
+          -serial "file:$(printf "%q" "$result_file")" \
+          -serial file:>(./helper-monitor.py ${TIMELINE:+-t "$TIMELINE"} ${MONITOR_FD}) \
+          -serial pty \
+          2>&1 | sed -u 's|^|HELPER: |g'
+    fi
 
     rc=$?
     set -e
     echo "$($DATE +%Y:%m:%d-%H:%M:%S.%N) VM STOP" >&2
+    stage_end helper-vm "rc=$rc" "boot=$boot"
 
     check_helper_rc "$rc"
 
     report_info "Checking customization status..."
-    # Read the first line. This will remove \r and \n chars
-    result=$(sed 's|\r||g' "$result_file" | head -1)
+    # Read the first line. This will remove \r and \n chars. A helper VM that
+    # waited for its disks may repeat the READY line it sent before.
+    result=$(sed 's|\r||g' "$result_file" | grep -v '^READY$' | head -1)
     report_info "Customization status is: $result"
 
     check_helper_result "$result"
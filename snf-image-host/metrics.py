@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Utility that keeps node-wide metrics of the snf-image operations.
+
+The metrics are stored in a file in the text format of Prometheus, which may
+be exported by the textfile collector of the Prometheus node exporter. The
+utility adds the outcome of an operation to the metrics already found in the
+file and atomically replaces it. The operation is described by the
+image-timeline monitoring message produced by timeline.py, which is read from
+the standard input.
+"""
+
+import sys
+import os
+import re
+import json
+import time
+import fcntl
+import tempfile
+import optparse
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+PREFIX = 'snf_image_'
+
+MiB = 1 << 20
+
+# (name, type, help, histogram buckets)
+METRICS = [
+    ('operations_started_total', 'counter',
+     'Number of snf-image operations started', None),
+    ('operations_total', 'counter',
+     'Number of snf-image operations finished, by result', None),
+    ('last_operation_timestamp_seconds', 'gauge',
+     'Time the last snf-image operation finished', None),
+    ('copied_bytes_total', 'counter',
+     'Number of image bytes copied, by storage back-end', None),
+    ('copy_throughput_bytes_per_second', 'histogram',
+     'Throughput of the image copy',
+     [m * MiB for m in (8, 16, 32, 64, 128, 256, 512, 1024)]),
+    ('helper_duration_seconds', 'histogram',
+     'Run time of the helper VM',
+     [5, 10, 20, 30, 60, 120, 300, 600]),
+    ('helper_boot_seconds', 'histogram',
+     'Time the helper VM needed to boot',
+     [1, 2, 5, 10, 20, 30, 60]),
+    ('task_duration_seconds', 'histogram',
+     'Run time of the configuration tasks of the helper VM',
+     [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]),
+]
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)",?')
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-f", "--file", type="string", dest="file",
+                      default=None, metavar="FILE",
+                      help="store the metrics in FILE")
+    parser.add_option("-o", "--operation", type="string", dest="operation",
+                      default=None, metavar="OPERATION",
+                      help="the name of the operation (create, import, "
+                      "export)")
+    parser.add_option("-l", "--label", action="append", dest="labels",
+                      default=[], metavar="KEY=VALUE",
+                      help="add a label to the metrics of the operation")
+    parser.add_option("-s", "--started", action="store_true", dest="started",
+                      default=False,
+                      help="only record that the operation has started")
+    parser.add_option("-r", "--result", type="string", dest="result",
+                      default=None, metavar="RESULT",
+                      help="the result of the operation (success, failure)")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 0:
+        parser.error('Wrong number of arguments')
+
+    if options.file is None:
+        parser.error('The metrics file is missing')
+
+    if options.operation is None:
+        parser.error('The operation is missing')
+
+    if not options.started and options.result is None:
+        parser.error('Either the operation has started or it has a result')
+
+    labels = {}
+    for label in options.labels:
+        key, sep, value = label.partition('=')
+        if not sep:
+            parser.error('Invalid label: %s' % label)
+        labels[key] = value
+    options.labels = labels
+
+    return options
+
+
+def escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def unescape(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                  else m.group(1), value)
+
+
+def read_metrics(path):
+    """Returns the samples found in a metrics file as a dictionary"""
+    samples = {}
+    try:
+        f = open(path)
+    except IOError:
+        return samples
+
+    with f:
+        for line in f:
+            m = SAMPLE.match(line.strip())
+            if line.startswith('#') or not m:
+                continue
+            name, labels, value = m.groups()
+            labels = tuple((k, unescape(v)) for k, v in
+                           LABEL.findall(labels or ""))
+            samples[(name, labels)] = float(value)
+
+    return samples
+
+
+def sort_key(key):
+    """Sorts the buckets of a histogram by their upper bound"""
+    name, labels = key
+    return (name, [(k, float(v) if k == 'le' else v) for k, v in labels])
+
+
+def write_metrics(path, samples):
+    """Atomically replaces a metrics file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for name, kind, help_, _ in METRICS:
+                keys = sorted((k for k in samples
+                               if k[0] == PREFIX + name or
+                               k[0].rsplit('_', 1)[0] == PREFIX + name and
+                               kind == 'histogram'), key=sort_key)
+                if not keys:
+                    continue
+                f.write("# HELP %s%s %s\n" % (PREFIX, name, help_))
+                f.write("# TYPE %s%s %s\n" % (PREFIX, name, kind))
+                for key in keys:
+                    labels = ",".join('%s="%s"' % (k, escape(v))
+                                      for k, v in key[1])
+                    f.write("%s%s %s\n" % (key[0], "{%s}" % labels
+                                           if labels else "",
+                                           repr(float(samples[key]))))
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class Metrics(object):
+    """The samples produced by a single operation"""
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+
+    @staticmethod
+    def key(name, labels):
+        # Empty labels are equivalent to missing ones
+        return (PREFIX + name, tuple(sorted((k, v) for k, v in labels.items()
+                                            if v != '')))
+
+    def inc(self, name, labels, value=1):
+        key = self.key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        buckets = [m[3] for m in METRICS if m[0] == name][0]
+        for le in buckets + [float('inf')]:
+            bucket = dict(labels)
+            bucket['le'] = "+Inf" if le == float('inf') else repr(le)
+            self.inc(name + '_bucket', bucket, 1 if value <= le else 0)
+        self.inc(name + '_sum', labels, value)
+        self.inc(name + '_count', labels)
+
+    def merge(self, samples):
+        """Adds the samples to the ones found in a metrics file"""
+        for key, value in self.counters.items():
+            samples[key] = samples.get(key, 0) + value
+        samples.update(self.gauges)
+        return samples
+
+
+def operation_metrics(metrics, msg, operation, result, labels):
+    """Computes the metrics of an operation out of its image-timeline
+    message"""
+    stages = dict((s['name'], s) for s in msg.get('stages', []))
+    backends = {
+        'src': stages.get('src-backend', {}).get('backend', ''),
+        'dst': stages.get('dst-backend', {}).get('backend', '')}
+
+    common = dict(labels)
+    common['operation'] = operation
+
+    outcome = dict(common)
+    outcome.update(backends)
+    outcome['result'] = result
+    metrics.inc('operations_total', outcome)
+    metrics.set('last_operation_timestamp_seconds', {'operation': operation},
+                msg.get('timestamp', time.time()))
+
+    copy = stages.get('copy')
+    if copy is not None:
+        copy_labels = {'operation': operation}
+        copy_labels.update(backends)
+        metrics.inc('copied_bytes_total', copy_labels, copy.get('bytes', 0))
+        if 'throughput' in copy:
+            metrics.observe('copy_throughput_bytes_per_second', copy_labels,
+                            copy['throughput'])
+
+    if 'helper-vm' in stages:
+        metrics.observe('helper_duration_seconds', labels,
+                        stages['helper-vm']['duration'])
+    if 'helper-boot' in stages:
+        metrics.observe('helper_boot_seconds', labels,
+                        stages['helper-boot']['duration'])
+
+    for name, stage in stages.items():
+        if name.startswith('task:'):
+            metrics.observe('task_duration_seconds',
+                            {'task': name[len('task:'):]}, stage['duration'])
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    metrics = Metrics()
+    if options.started:
+        labels = dict(options.labels)
+        labels['operation'] = options.operation
+        metrics.inc('operations_started_total', labels)
+    else:
+        try:
+            msg = json.loads(sys.stdin.read() or '{}')
+        except ValueError:
+            sys.stderr.write("%s: Invalid image-timeline message\n" %
+                             PROGNAME)
+            sys.exit(1)
+        operation_metrics(metrics, msg, options.operation, options.result,
+                          options.labels)
+
+    # Serialize the updates of concurrent operations
+    with open(options.file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        write_metrics(options.file,
+                      metrics.merge(read_metrics(options.file)))
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
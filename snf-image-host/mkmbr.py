@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Utility that creates the first MiB of a disk hosting a file system dump.
+
+The utility writes a Master Boot Record with a single bootable primary
+partition that starts at sector 2048 and covers a file system dump of the
+given size, followed by the gap up to the partition. This is what the
+following commands produce:
+
+    truncate -s $((size + 1024*1024)) disk
+    parted -s disk -- mklabel msdos mkpart primary <fstype> 2048s -1s \\
+        set 1 boot on
+    dd if=mbr.bin of=disk bs=440 count=1 conv=notrunc
+
+The CHS addresses are computed the way parted computes them for a disk image.
+"""
+
+import sys
+import os
+import struct
+import optparse
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+BLOCKSIZE = 512
+
+# The partition starts at 1MiB
+PART_START = 2048
+
+# The geometry parted assumes for disk images
+HEADS = 255
+SECTORS = 63
+
+PART_TYPES = {'ext2': 0x83, 'ntfs': 0x07}
+BOOTABLE = 0x80
+
+
+class MBR(object):
+    """Represents a Master Boot Record. The packing code is the same as the
+    one of the MBR class of disklabel.py in snf-image-helper."""
+    class Partition(object):
+        """Represents a partition entry in MBR"""
+        fmt = "<B3sB3sLL"
+
+        def __init__(self, raw_part):
+            """Create a Partition instance"""
+            (self.status,
+             self.start,
+             self.type,
+             self.end,
+             self.first_sector,
+             self.sector_count
+             ) = struct.unpack(self.fmt, raw_part)
+
+        def pack(self):
+            """Pack the partition values into a binary string"""
+            return struct.pack(self.fmt,
+                               self.status,
+                               self.start,
+                               self.type,
+                               self.end,
+                               self.first_sector,
+                               self.sector_count)
+
+        @staticmethod
+        def pack_chs(cylinder, head, sector):
+            """Packs a CHS tuple to an address string."""
+
+            assert 1 <= sector < 2**6, "Invalid sector value"
+            assert 0 <= head < 2**8, "Invalid head value"
+            assert 0 <= cylinder < 2**10, "Invalid cylinder value"
+
+            byte0 = head
+            byte1 = (cylinder >> 2) & 0xC0 | sector
+            byte2 = cylinder & 0xff
+
+            return struct.pack('<BBB', byte0, byte1, byte2)
+
+    def __init__(self, block):
+        """Create an MBR instance"""
+
+        self.fmt = "<444s2x16s16s16s16s2s"
+        raw_part = {}     # Offset  Length          Contents
+        (self.code_area,  # 0       440(max. 446)   code area
+                          # 440     2(optional)     disk signature
+                          # 444     2               Usually nulls
+         raw_part[0],     # 446     16              Partition 0
+         raw_part[1],     # 462     16              Partition 1
+         raw_part[2],     # 478     16              Partition 2
+         raw_part[3],     # 494     16              Partition 3
+         self.signature   # 510     2               MBR signature
+         ) = struct.unpack(self.fmt, block)
+
+        self.part = {}
+        for i in range(4):
+            self.part[i] = self.Partition(raw_part[i])
+
+    def pack(self):
+        """Pack an MBR to a binary string."""
+        return struct.pack(self.fmt,
+                           self.code_area,
+                           self.part[0].pack(),
+                           self.part[1].pack(),
+                           self.part[2].pack(),
+                           self.part[3].pack(),
+                           self.signature)
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options] <size> <fstype> <output>"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-b", "--boot-code", type="string", dest="boot_code",
+                      default="mbr.bin", metavar="FILE",
+                      help="read the boot code from FILE [default: "
+                      "%default]")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 3:
+        parser.error('Wrong number of arguments')
+
+    size, options.fstype, options.output = args
+
+    try:
+        options.size = int(size)
+    except ValueError:
+        parser.error("Invalid size: `%s'" % size)
+
+    if options.fstype not in PART_TYPES:
+        parser.error("Unknown file system type: `%s'" % options.fstype)
+
+    return options
+
+
+def lba2chs(lba):
+    """Returns the CHS address of an LBA address. Addresses past the first
+    1022 cylinders are clamped, like parted does."""
+    cylinder = lba // (HEADS * SECTORS)
+    head = (lba // SECTORS) % HEADS
+    sector = lba % SECTORS + 1
+
+    if cylinder > 1021:
+        return (1023, HEADS - 1, SECTORS)
+
+    return (cylinder, head, sector)
+
+
+def create_mbr(size, fstype, boot_code):
+    """Returns the MBR of a disk hosting a file system dump of the given size
+    in its first partition"""
+    # Like the disk file parted sees, the disk ends at a sector boundary
+    last_sector = (size + PART_START * BLOCKSIZE) // BLOCKSIZE - 1
+    if last_sector < PART_START:
+        raise ValueError("The file system is smaller than a sector")
+    if last_sector >= 2**32:
+        raise ValueError("The file system is too large for an MBR")
+
+    mbr = MBR('\0' * BLOCKSIZE)
+    # The disk signature is random, as the one parted writes
+    mbr.code_area = boot_code[:440].ljust(440, '\0') + os.urandom(4)
+    mbr.signature = '\x55\xaa'
+
+    part = mbr.part[0]
+    part.status = BOOTABLE
+    part.type = PART_TYPES[fstype]
+    part.first_sector = PART_START
+    part.sector_count = last_sector - PART_START + 1
+    part.start = part.pack_chs(*lba2chs(PART_START))
+    part.end = part.pack_chs(*lba2chs(last_sector))
+
+    return mbr.pack()
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    try:
+        with open(options.boot_code, 'rb') as f:
+            boot_code = f.read()
+        mbr = create_mbr(options.size, options.fstype, boot_code)
+        with open(options.output, 'wb') as f:
+            f.write(mbr)
+            f.truncate(PART_START * BLOCKSIZE)
+    except (ValueError, IOError) as e:
+        sys.stderr.write("%s: %s\n" % (PROGNAME, e))
+        sys.exit(1)
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Multiplexer of the monitoring messages of a deployment.
+
+A single instance of this utility runs during a deployment. It reads events
+from its standard input, one per line, and prints monitoring messages to its
+standard output, which is connected to the progress monitor. An event is
+either a monitoring message produced by copy-monitor.py, helper-monitor.py or
+timeline.py, which is a JSON object, or a line produced by the shell scripts
+of snf-image with the following format:
+
+    <event-type> <text>
+
+where event-type is one of `info', `error' and `stderr' and newlines and
+backslashes in the text are escaped with a backslash.
+
+The copy progress messages are coalesced: only the most recent one is sent
+and at most one message per interval is sent, unless the copy is finished.
+"""
+
+import sys
+import os
+import re
+import json
+import time
+import select
+import optparse
+
+MSG_TYPE_ERROR = "image-error"
+MSG_TYPE_INFO = "image-info"
+MSG_TYPE_PROGRESS = "image-copy-progress"
+
+PROTOCOL = {
+    "error": (MSG_TYPE_ERROR, "messages"),
+    "stderr": (MSG_TYPE_ERROR, "stderr"),
+    "info": (MSG_TYPE_INFO, "messages")
+}
+
+BUFSIZE = 8192
+LINESIZE = 65536
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-i", "--interval", type="float", dest="interval",
+                      default=1.0, metavar="SECONDS",
+                      help="send at most one copy progress message every "
+                      "SECONDS seconds")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 0:
+        parser.error('Wrong number of arguments')
+
+    return options
+
+
+def unescape(text):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                  else m.group(1), text)
+
+
+class Multiplexer(object):
+    def __init__(self, out, interval):
+        self.out = out
+        self.interval = interval
+        self.progress = None
+        self.last_progress = 0
+
+    def parse(self, line):
+        """Converts an event to a monitoring message"""
+        if line.startswith('{'):
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                msg = None
+            if isinstance(msg, dict) and 'type' in msg:
+                return msg
+            sys.stderr.write("%s: Invalid message: %s\n" % (PROGNAME, line))
+            return None
+
+        event, _, text = line.partition(' ')
+        if event not in PROTOCOL:
+            sys.stderr.write("%s: Unknown event: %s\n" % (PROGNAME, event))
+            return None
+
+        msg_type, field = PROTOCOL[event]
+        text = unescape(text)
+        msg = {'type': msg_type}
+        if event == 'stderr':
+            msg[field] = text
+        else:
+            msg[field] = [l.strip() for l in text.split('\n')]
+        return msg
+
+    def send(self, msg):
+        if 'timestamp' not in msg:
+            msg['timestamp'] = time.time()
+        self.out.write("%s\n" % json.dumps(msg))
+        self.out.flush()
+
+    def flush(self):
+        """Sends the pending copy progress message"""
+        if self.progress is not None:
+            self.send(self.progress)
+            self.progress = None
+            self.last_progress = time.time()
+
+    def timeout(self):
+        """Returns the time until the pending copy progress message is due"""
+        if self.progress is None:
+            return None
+        return max(0, self.last_progress + self.interval - time.time())
+
+    def process(self, line):
+        msg = self.parse(line)
+        if msg is None:
+            return
+
+        if msg['type'] == MSG_TYPE_PROGRESS:
+            self.progress = msg
+            if msg.get('position') == msg.get('total') or \
+                    self.timeout() == 0:
+                self.flush()
+        else:
+            # Keep the messages in order
+            self.flush()
+            self.send(msg)
+
+    def run(self, fd):
+        data = ""
+        while True:
+            ready, _, _ = select.select([fd], [], [], self.timeout())
+            if not ready:
+                self.flush()
+                continue
+
+            buf = os.read(fd, BUFSIZE)
+            if not buf:
+                break
+            data += buf
+
+            lines = data.split('\n')
+            data = lines.pop()
+            if len(data) > LINESIZE:
+                sys.stderr.write("%s: Line size exceeded the maximum allowed "
+                                 "size\n" % PROGNAME)
+                data = ""
+
+            for line in lines:
+                line = line.strip()
+                if line:
+                    self.process(line)
+
+        if data.strip():
+            self.process(data.strip())
+        self.flush()
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    Multiplexer(sys.stdout, options.interval).run(sys.stdin.fileno())
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
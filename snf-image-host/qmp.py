@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Utility that drives the helper VM through the QEMU Machine Protocol.
+
+The utility connects to the QMP socket of a helper VM and executes the
+commands it reads from its standard input, one per line, in the following
+format:
+
+    <command> [<arguments as a JSON object>]
+
+If the VM is receiving an incoming migration, the commands are executed after
+it has finished. A `migrate' command returns after the migration has finished.
+The `wait-connected' pseudo-command, whose `labels' argument is a list of
+socket character devices, returns once a client has connected to each one of
+them.
+
+The non-empty return values of the commands are printed to the standard
+output, one per line.
+"""
+
+import sys
+import os
+import json
+import time
+import errno
+import socket
+import optparse
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+POLL_INTERVAL = 0.05
+
+
+class QMPError(Exception):
+    pass
+
+
+class QMP(object):
+    """A connection to the QMP socket of a VM"""
+    def __init__(self, path, timeout):
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # The socket may not have been created yet
+        while True:
+            try:
+                self.sock.connect(path)
+                break
+            except socket.error as e:
+                if e.errno not in (errno.ENOENT, errno.ECONNREFUSED) or \
+                        time.time() > self.deadline:
+                    raise QMPError("Unable to connect to `%s': %s" %
+                                   (path, e.strerror))
+                time.sleep(POLL_INTERVAL)
+
+        self.sock.settimeout(timeout)
+        self.file = self.sock.makefile('r')
+        self.events = []
+
+        # Read the greeting and enter the command mode
+        self.receive()
+        self.execute('qmp_capabilities')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def receive(self):
+        try:
+            line = self.file.readline()
+        except socket.timeout:
+            raise QMPError("Timed out waiting for the VM")
+        if not line:
+            raise QMPError("The VM closed the connection")
+        return json.loads(line)
+
+    def execute(self, command, arguments=None):
+        """Executes a command and returns its return value"""
+        request = {'execute': command}
+        if arguments:
+            request['arguments'] = arguments
+        self.sock.sendall("%s\n" % json.dumps(request))
+
+        while True:
+            response = self.receive()
+            if 'event' in response:
+                self.events.append(response)
+            elif 'error' in response:
+                raise QMPError("%s: %s" % (command,
+                                           response['error']['desc']))
+            elif 'return' in response:
+                return response['return']
+
+    def poll(self, command, done):
+        """Executes a query command until its return value satisfies done"""
+        deadline = time.time() + self.timeout
+        while True:
+            ret = self.execute(command)
+            if done(ret):
+                return ret
+            if time.time() > deadline:
+                raise QMPError("Timed out waiting for `%s'" % command)
+            time.sleep(POLL_INTERVAL)
+
+    def wait_incoming(self):
+        """Waits until an incoming migration, if any, has finished"""
+        status = self.poll('query-status',
+                           lambda r: r['status'] != 'inmigrate')
+        if status['status'] in ('internal-error', 'io-error', 'shutdown'):
+            raise QMPError("Incoming migration failed: %s" %
+                           status['status'])
+
+    def wait_connected(self, labels):
+        """Waits until a client has connected to each of the socket character
+        devices"""
+        self.poll('query-chardev', lambda r: not [
+            c for c in r if c['label'] in labels and
+            c['filename'].startswith('disconnected:')])
+
+    def migrate(self, arguments):
+        """Migrates the VM and waits until the migration has finished"""
+        self.execute('migrate', arguments)
+        ret = self.poll('query-migrate', lambda r: r.get('status') in
+                        ('completed', 'failed', 'cancelled'))
+        if ret['status'] != 'completed':
+            raise QMPError("Migration %s" % ret['status'])
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options] <socket>"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-t", "--timeout", type="float", dest="timeout",
+                      default=30, metavar="SECONDS",
+                      help="give up if the VM does not respond in SECONDS "
+                      "seconds")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+
+    options.socket = args[0]
+
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    try:
+        qmp = QMP(options.socket, options.timeout)
+        qmp.wait_incoming()
+
+        for line in sys.stdin:
+            command, _, arguments = line.strip().partition(' ')
+            if not command:
+                continue
+            arguments = json.loads(arguments) if arguments else None
+
+            if command == 'migrate':
+                qmp.migrate(arguments)
+                continue
+            elif command == 'wait-connected':
+                qmp.wait_connected(arguments['labels'])
+                continue
+
+            ret = qmp.execute(command, arguments)
+            if ret:
+                sys.stdout.write("%s\n" % json.dumps(ret))
+                sys.stdout.flush()
+
+        qmp.close()
+    except (QMPError, ValueError, socket.error) as e:
+        sys.stderr.write("%s: %s\n" % (PROGNAME, e))
+        sys.exit(1)
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
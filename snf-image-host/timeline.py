@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Utility that summarizes the timeline of an image deployment.
+
+The timeline file is filled by snf-image and helper-monitor.py while an image
+is deployed. Each line describes a stage of the deployment and has the
+following tab-separated fields: the name of the stage, its start and end time
+in seconds since the epoch and optionally a number of KEY=VALUE arguments.
+Stages whose start and end times are equal mark a point in time.
+
+The utility prints an image-timeline monitoring message to stdout and
+optionally writes the timeline in the Chrome trace event format.
+"""
+
+import sys
+import os
+import json
+import time
+import optparse
+
+MSG_TYPE = 'image-timeline'
+TASK_PREFIX = 'task:'
+HELPER_VM = 'helper-vm'
+HELPER_BOOT = 'helper-boot'
+HELPER_FIRST_MESSAGE = 'helper-first-message'
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+
+def parse_options(input_args):
+    usage = "Usage: %prog [options] <timeline-file>"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-c", "--chrome-trace", type="string", dest="trace",
+                      default=None, metavar="FILE",
+                      help="write the timeline to FILE in the Chrome trace "
+                      "event format")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+
+    options.timeline = args[0]
+
+    return options
+
+
+def parse_value(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_stages(path):
+    """Returns the stages in a timeline file, sorted by their start time"""
+    stages = []
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                continue
+            stage = {'name': fields[0], 'start': float(fields[1]),
+                     'end': float(fields[2])}
+            for arg in fields[3:]:
+                key, _, value = arg.partition('=')
+                stage[key] = parse_value(value)
+            stage['duration'] = round(stage['end'] - stage['start'], 6)
+            stages.append(stage)
+
+    # The helper VM boots until it sends its first message
+    vm = [s for s in stages if s['name'] == HELPER_VM]
+    first = [s for s in stages if s['name'] == HELPER_FIRST_MESSAGE]
+    if vm and first:
+        stages.append({'name': HELPER_BOOT, 'start': vm[0]['start'],
+                       'end': first[0]['start'],
+                       'duration': round(first[0]['start'] -
+                                         vm[0]['start'], 6)})
+    stages = [s for s in stages if s['name'] != HELPER_FIRST_MESSAGE]
+
+    for stage in stages:
+        if 'bytes' in stage and stage['duration'] > 0:
+            stage['throughput'] = int(stage['bytes'] / stage['duration'])
+
+    return sorted(stages, key=lambda s: (s['start'], -s['end']))
+
+
+def chrome_trace(stages):
+    """Converts a list of stages to the Chrome trace event format. The stages
+    that run in the helper VM are displayed in a separate thread."""
+    events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 1,
+         'args': {'name': 'snf-image'}},
+        {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1,
+         'args': {'name': 'host'}},
+        {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 2,
+         'args': {'name': 'helper'}}]
+
+    for stage in stages:
+        args = dict((k, v) for k, v in stage.items()
+                    if k not in ('name', 'start', 'end', 'duration'))
+        helper = stage['name'].startswith(TASK_PREFIX)
+        events.append({
+            'name': stage['name'][len(TASK_PREFIX):] if helper else
+            stage['name'],
+            'cat': 'helper' if helper else 'host',
+            'ph': 'X', 'pid': 1, 'tid': 2 if helper else 1,
+            'ts': int(stage['start'] * 1000000),
+            'dur': int(stage['duration'] * 1000000),
+            'args': args})
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+if __name__ == "__main__":
+    options = parse_options(sys.argv[1:])
+
+    stages = read_stages(options.timeline)
+
+    if options.trace is not None:
+        with open(options.trace, 'w') as f:
+            json.dump(chrome_trace(stages), f)
+
+    msg = {}
+    msg['type'] = MSG_TYPE
+    msg['stages'] = stages
+    if stages:
+        msg['duration'] = round(max(s['end'] for s in stages) -
+                                min(s['start'] for s in stages), 6)
+    msg['timestamp'] = time.time()
+    sys.stdout.write("%s\n" % json.dumps(msg))
+
+    sys.exit(0)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
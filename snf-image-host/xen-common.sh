@@ -37,6 +37,7 @@ launch_helper() {
 
     report_info "Starting customization VM..."
     echo "$($DATE +%Y:%m:%d-%H:%M:%S.%N) VM START" >&2
+    stage_begin helper-vm
 
     set -- c d e f g h i j k l m n o p q r
     for ((i = 0; i < DISK_COUNT; i++)); do
@@ -66,7 +67,7 @@ ramdisk='$HELPER_DIR/initrd'
 root='/dev/xvda'
 memory='$HELPER_MEMORY'
 boot='c'
-vcpus=1
+vcpus=$(helper_vcpus)
 name='$name'
 extra='console=hvc0 hypervisor=$HYPERVISOR snf_image_activate_helper ipv6.disable=1 rules_dev=/dev/xvdb ro boot=local helper_ip=10.0.0.1 monitor_port=48888 init=/usr/bin/snf-image-helper'
 disk=['file:$HELPER_DIR/image,xvda,r','file:$floppy,xvdb,r'$disks]
@@ -89,16 +90,18 @@ EOF
 
     filter='udp and dst port 48888 and dst host 10.0.0.255 and src host 10.0.0.1'
     $TIMEOUT -k $HELPER_HARD_TIMEOUT $HELPER_SOFT_TIMEOUT \
-      ./helper-monitor.py -i "vif${helperid}.0" -f "$filter" ${MONITOR_FD} &
+      ./helper-monitor.py -i "vif${helperid}.0" -f "$filter" \
+      ${TIMELINE:+-t "$TIMELINE"} ${MONITOR_FD} &
     monitor_pid=$!
 
     set +e
     $TIMEOUT -k $HELPER_HARD_TIMEOUT $HELPER_SOFT_TIMEOUT \
-      socat EXEC:"$XEN_CMD console $name",pty STDOUT | sed -u 's|^|HELPER: |g'
+      $SOCAT EXEC:"$XEN_CMD console $name",pty STDOUT | sed -u 's|^|HELPER: |g'
     rc=$?
     set -e
 
     echo "$($DATE +%Y:%m:%d-%H:%M:%S.%N) VM STOP" >&2
+    stage_end helper-vm "rc=$rc"
 
     check_helper_rc "$rc"
 